@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# ==============================================================================
+# Measures how many lines per second make it through message () and the
+# buffered output writer. Output is sent to /dev/null so only the formatting
+# and batching costs are measured.
+#
+#    ./benchmarks/log_throughput.py [lines]
+# ==============================================================================
+
+import os
+import sys
+import time
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import regilo
+
+# ==============================================================================
+
+def benchmark (label:str, lines:int, function):
+	start = time.perf_counter ()
+	function (lines)
+	regilo.outputFlush ()
+	elapsed = time.perf_counter () - start
+
+	sys.stderr.write ("%-24s %10i lines %8.3fs %12.0f lines/sec\n" % (label, lines, elapsed, lines / elapsed))
+
+def serviceLines (lines:int):
+	for number in range (lines):
+		regilo.message ("service", "GET /index.html HTTP/1.1 200 %i" % (number,))
+
+def pumpedLines (lines:int):
+	batch = ["GET /index.html HTTP/1.1 200 %i" % (number,) for number in range (100)]
+	for _ in range (lines // len (batch)):
+		regilo.messageLines ("service", batch)
+
+def noticeLines (lines:int):
+	for number in range (lines):
+		regilo.notice ("Periodic started: job-%i" % (number,))
+
+def wrappedLines (lines:int):
+	for number in range (lines):
+		regilo.wrapOutput ("startup output %i" % (number,))
+
+# ==============================================================================
+
+def main ():
+	lines = int (sys.argv [1]) if len (sys.argv) > 1 else 500000
+
+	regilo.OUTPUT ["fd"] = os.open (os.devnull, os.O_WRONLY)
+
+	benchmark ("service output", lines, serviceLines)
+	benchmark ("service output (pump)", lines, pumpedLines)
+	benchmark ("notice", lines, noticeLines)
+	benchmark ("startup output", lines, wrappedLines)
+
+# ==============================================================================
+
+if __name__ == "__main__":
+	main ()
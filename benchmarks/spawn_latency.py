@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# ==============================================================================
+# Measures how long it takes to start a child and see it exit, through the
+# posix_spawn () backend and through subprocess.Popen. Ballast is allocated
+# first to show how the supervisor's own size affects each of them. Run as
+# root to include children that drop privileges.
+#
+#    ./benchmarks/spawn_latency.py [spawns] [ballast MiB]
+# ==============================================================================
+
+import os
+import sys
+import time
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+import regilo
+
+# ==============================================================================
+
+def benchmark (label:str, spawns:int, backend:str, output:bool, user:str = None):
+	regilo.SPAWN ["backend"] = backend
+	timings = []
+
+	for _ in range (spawns):
+		start = time.perf_counter ()
+		process = regilo.spawnProcess ("/bin/true", [], user = user, group = user, output = output)
+		if process.stdout is not None:
+			process.stdout.read ()
+			process.stdout.close ()
+		process.wait ()
+		timings.append (time.perf_counter () - start)
+
+	timings.sort ()
+	sys.stderr.write ("%-32s %8i spawns %10.1fus median %10.1fus p99 %10.0f spawns/sec\n" % (
+		label,
+		spawns,
+		timings [len (timings) // 2] * 1000000,
+		timings [int (len (timings) * 0.99)] * 1000000,
+		spawns / sum (timings)
+	))
+
+# ==============================================================================
+
+def main ():
+	spawns = int (sys.argv [1]) if len (sys.argv) > 1 else 2000
+	ballast_size = int (sys.argv [2]) if len (sys.argv) > 2 else 512
+
+	# The ballast is written to so its pages are really there to be copied
+	for ballast in (None, bytearray (b"\xff") * (ballast_size * 1048576)):
+		size = "" if ballast is None else " +%iMiB" % (ballast_size,)
+
+		benchmark ("posix_spawn" + size, spawns, "auto", True)
+		benchmark ("popen" + size, spawns, "popen", True)
+		benchmark ("posix_spawn, no output" + size, spawns, "auto", False)
+		benchmark ("popen, no output" + size, spawns, "popen", False)
+
+		if os.getuid () == 0:
+			if regilo.SPAWN ["setpriv"] is not None:
+				benchmark ("setpriv, user" + size, spawns, "auto", True, "root")
+			benchmark ("popen, user" + size, spawns, "popen", True, "root")
+
+# ==============================================================================
+
+if __name__ == "__main__":
+	main ()
@@ -18,18 +18,35 @@ exec "python3" "${0}" "${@}"
 # """
 # ==============================================================================
 
+import atexit
+import collections
+import concurrent.futures
+import ctypes
+import dataclasses
 import datetime
+import errno
+import functools
 import grp
+import gzip
 import hashlib
+import heapq
+import http.server
+import itertools
 import json
+import math
 import os
 import pwd
+import random
 import re
 import selectors
 import shlex
+import shutil
 import signal
+import socket
+import socketserver
 import subprocess
 import sys
+import tempfile
 import textwrap
 import threading
 import time
@@ -81,6 +98,7 @@ def generateKey (*args):
 
 # ==============================================================================
 
+@functools.lru_cache (maxsize = None)
 def ansiColorParse (data:str, foreground = True) -> str:
 	vga_map = {
 		"black": 30,
@@ -112,6 +130,7 @@ def ansiColorParse (data:str, foreground = True) -> str:
 
 	return None
 
+@functools.lru_cache (maxsize = None)
 def ansiColor (
 	reset:bool = False,
 	bright:bool = False,
@@ -167,6 +186,110 @@ def ansiColor (
 
 # ==============================================================================
 
+OUTPUT_FLUSH_SIZE = 65536
+OUTPUT_FLUSH_INTERVAL = 0.05
+OUTPUT_BUFFER_LIMIT = 4194304
+OUTPUT_FLUSH_TIMEOUT = 1.0
+
+OUTPUT = {
+	"condition": threading.Condition (threading.Lock ()),
+	"lock": threading.Lock (),
+	"buffer": [],
+	"size": 0,
+	"generation": 0,
+	"thread": None,
+	"fd": 1,
+	"format": "text"
+}
+OUTPUT_LOCAL = threading.local ()
+
+def outputWriteAll (data:bytes):
+	view = memoryview (data)
+	try:
+		while len (view) > 0:
+			written = os.write (OUTPUT ["fd"], view)
+			view = view [written:]
+	except OSError:
+		# Nobody is left to read it, which must not stall whoever is waiting
+		# for the buffer to drain
+		pass
+
+def outputTake () -> bytes:
+	with OUTPUT ["condition"]:
+		buffer = OUTPUT ["buffer"]
+		OUTPUT ["buffer"] = []
+		OUTPUT ["size"] = 0
+		OUTPUT ["generation"] += 1
+		OUTPUT ["condition"].notify_all ()
+
+	return "".join (buffer).encode ("utf8", errors = "replace")
+
+def outputRun ():
+	while True:
+		with OUTPUT ["condition"]:
+			while OUTPUT ["size"] == 0:
+				OUTPUT ["condition"].wait ()
+
+			# Give more lines a chance to join the batch
+			if OUTPUT ["size"] < OUTPUT_FLUSH_SIZE:
+				OUTPUT ["condition"].wait (OUTPUT_FLUSH_INTERVAL)
+
+		with OUTPUT ["lock"]:
+			outputWriteAll (outputTake ())
+
+def outputFlush ():
+	# A writer stuck on a full stdout must not keep the supervisor from exiting
+	if not OUTPUT ["lock"].acquire (timeout = OUTPUT_FLUSH_TIMEOUT):
+		return
+
+	try:
+		outputWriteAll (outputTake ())
+	finally:
+		OUTPUT ["lock"].release ()
+
+def output (*strings:str):
+	if (capture := getattr (OUTPUT_LOCAL, "capture", None)) is not None:
+		capture.extend (strings)
+		return
+
+	with OUTPUT ["condition"]:
+		if OUTPUT ["thread"] is None:
+			OUTPUT ["thread"] = threading.Thread (target = outputRun, name = "output", daemon = True)
+			OUTPUT ["thread"].start ()
+
+		was_empty = OUTPUT ["size"] == 0
+
+		for string in strings:
+			OUTPUT ["buffer"].append (string + "\n")
+			OUTPUT ["size"] += len (string) + 1
+
+		if was_empty or OUTPUT ["size"] >= OUTPUT_FLUSH_SIZE:
+			OUTPUT ["condition"].notify_all ()
+
+		# A slow stdout holds up the pump, and with it the children, as a
+		# blocking write would, instead of letting the buffer grow without
+		# bound. The supervisor itself is never held up, so it can still stop,
+		# and neither is the pump, which holds back each source on its own
+		while OUTPUT ["size"] > OUTPUT_BUFFER_LIMIT and threading.current_thread () is not threading.main_thread () and getattr (OUTPUT_LOCAL, "unbounded", False) == False:
+			OUTPUT ["condition"].wait ()
+
+def outputCapture (prefix:str = None):
+	OUTPUT_LOCAL.capture = []
+	OUTPUT_LOCAL.prefix = prefix
+
+def outputRelease ():
+	captured = OUTPUT_LOCAL.capture
+	OUTPUT_LOCAL.capture = None
+	OUTPUT_LOCAL.prefix = None
+
+	# Everything captured is written as one block so it cannot interleave
+	if len (captured) > 0:
+		output (*captured)
+
+atexit.register (outputFlush)
+
+# ==============================================================================
+
 INDENT = 0
 
 def indent ():
@@ -177,58 +300,125 @@ def outdent ():
 	if INDENT < 0:
 		INDENT = 0
 
+ANSI_RESET = ansiColor (reset = True)
+ANSI_WRAP = ansiColor (reset = True) + "%7s" % ("",) + ansiColor (bright = True, foreground = "white") + " | " + ansiColor (reset = True)
+ANSI_MESSAGE = ansiColor (reset = True, bright = True, foreground = "white")
+
+ANSI_DEBUG = ansiColor (reset = True, bright = True, foreground = "cyan")
+ANSI_INFO = ansiColor (reset = True, bright = True, foreground = "white")
+ANSI_NOTICE = ansiColor (reset = True, bright = True, foreground = "green")
+ANSI_WARNING = ansiColor (reset = True, bright = True, foreground = "yellow")
+ANSI_ERROR = ansiColor (reset = True, bright = True, foreground = "red")
+ANSI_FATAL = ansiColor (reset = True, bright = True, blink = True, foreground = "red")
+
+MESSAGE_PREFIXES = {}
+MESSAGE_LEVELS = {
+	"Debug": "debug",
+	"Info": "info",
+	"Notice": "notice",
+	"Warning": "warning",
+	"Error": "error",
+	"Fatal": "fatal"
+}
+LOG_FORMATS = ("text", "json")
+
+def messagePrefix (prefix:str, prefix_ansi:str = None, color:bool = True) -> tuple[str, str]:
+	cache_key = (prefix, prefix_ansi, color)
+
+	if (cached := MESSAGE_PREFIXES.get (cache_key)) is not None:
+		return cached
+
+	_prefix = prefix [0:7]
+	if color == True and prefix_ansi is not None:
+		cached = ("%s%7s%s | " % (prefix_ansi, _prefix, ANSI_MESSAGE), ANSI_RESET)
+	else:
+		cached = ("%7s | " % (_prefix,), "")
+
+	MESSAGE_PREFIXES [cache_key] = cached
+	return cached
+
+def logTimestamp () -> str:
+	now = time.time ()
+	return "%s.%03iZ" % (time.strftime ("%Y-%m-%dT%H:%M:%S", time.gmtime (now)), int (now * 1000) % 1000)
+
+def logRecords (service:str, level:str, lines:list[str]) -> list[str]:
+	# Everything but the line is the same for the whole batch
+	head = "{\"ts\":\"%s\",\"service\":%s,\"level\":\"%s\",\"line\":" % (logTimestamp (), json.dumps (service, ensure_ascii = False), level)
+	return [head + json.dumps (line, ensure_ascii = False) + "}" for line in lines]
+
 def wrapOutput (string:str, color:bool = True):
-	lines = string.split ("\n")
-	for line in lines:
-		if color == True:
-			print ("%s%7s%s | %s%s%s" % (ansiColor (reset = True), "", ansiColor (bright = True, foreground = "white"), ansiColor (reset = True), INDENT_STRING * INDENT, line))
-		else:
-			print ("%7s | %s%s" % ("", INDENT_STRING * INDENT, line))
+	if OUTPUT ["format"] == "json":
+		output (*logRecords (getattr (OUTPUT_LOCAL, "prefix", None), "info", string.split ("\n")))
+		return
+
+	_indent = INDENT_STRING * INDENT
+	if (prefix := getattr (OUTPUT_LOCAL, "prefix", None)) is not None:
+		_prefix = messagePrefix (prefix)[0] + _indent
+	else:
+		_prefix = (ANSI_WRAP if color == True else "%7s | " % ("",)) + _indent
+
+	output (*[_prefix + line for line in string.split ("\n")])
 
 def message (prefix:str, string:str, prefix_ansi:str = None, color:bool = True):
-	_prefix = prefix [0:7]
-	first = True
+	if OUTPUT ["format"] == "json":
+		output (*logRecords (getattr (OUTPUT_LOCAL, "prefix", None), MESSAGE_LEVELS.get (prefix, "info"), [string]))
+		return
+
+	_indent = INDENT_STRING * INDENT
+	_prefix, _suffix = messagePrefix (prefix, prefix_ansi, color)
+
+	if "\n" not in string:
+		output (_prefix + _indent + string + _suffix)
+		return
+
 	lines = string.split ("\n")
-	for line in lines:
-		if first == True:
-			first = False
-			if color == True and prefix_ansi is not None:
-				print ("%s%7s%s | %s%s%s" % (prefix_ansi, _prefix, ansiColor (reset = True, bright = True, foreground = "white"), INDENT_STRING * INDENT, line, ansiColor (reset = True)))
-			else:
-				print ("%7s | %s%s" % (_prefix, INDENT_STRING * INDENT, line))
-		else:
-			print ("%7s | %s%s" % ("", INDENT_STRING * INDENT, line))
+	output (
+		_prefix + _indent + lines [0] + _suffix,
+		*["%7s | %s%s" % ("", _indent, line) for line in lines [1:]]
+	)
+
+def messageLines (prefix:str, lines:list[str], prefix_ansi:str = None, color:bool = True):
+	if OUTPUT ["format"] == "json":
+		output (*logRecords (prefix, "output", lines))
+		return
+
+	_prefix, _suffix = messagePrefix (prefix, prefix_ansi, color)
+	_prefix = _prefix + INDENT_STRING * INDENT
+
+	output (*[_prefix + line + _suffix for line in lines])
 
 def debug (string:str, color:bool = True):
-	message ("Debug", string, ansiColor (reset = True, bright = True, foreground = "cyan"), color)
+	message ("Debug", string, ANSI_DEBUG, color)
 
 def info (string:str, color:bool = True):
-	message ("Info", string, ansiColor (reset = True, bright = True, foreground = "white"), color)
+	message ("Info", string, ANSI_INFO, color)
 
 def notice (string:str, color:bool = True):
-	message ("Notice", string, ansiColor (reset = True, bright = True, foreground = "green"), color)
+	message ("Notice", string, ANSI_NOTICE, color)
 
 def warning (string:str, color:bool = True):
-	message ("Warning", string, ansiColor (reset = True, bright = True, foreground = "yellow"), color)
+	message ("Warning", string, ANSI_WARNING, color)
 
 def error (string:str, color:bool = True):
-	message ("Error", string, ansiColor (reset = True, bright = True, foreground = "red"), color)
+	message ("Error", string, ANSI_ERROR, color)
 
 def fatal (string:str, color:bool = True):
-	message ("Fatal", string, ansiColor (reset = True, bright = True, blink = True, foreground = "red"), color)
+	message ("Fatal", string, ANSI_FATAL, color)
+	sinkExit ()
+	outputFlush ()
 	os._exit (1)
 
 def separator (character:str = "-", width:int = 80, color:bool = True, pad:bool = True):
 	if pad == True:
-		print ("")
+		output ("")
 
 	if color == True:
-		print ("%s%s%s" % (ansiColor (reset = True, bright = True, foreground = "black"), character * width, ansiColor (reset = True)))
+		output ("%s%s%s" % (ansiColor (reset = True, bright = True, foreground = "black"), character * width, ANSI_RESET))
 	else:
-		print (character * width)
+		output (character * width)
 
 	if pad == True:
-		print ("")
+		output ("")
 
 # ==============================================================================
 
@@ -257,50 +447,612 @@ def banner_print (
 	if subtitle is not None and padding - len (subtitle) - 1 < 0:
 		subtitle = subtitle [0:padding -1]
 
-	banner = banner_string % (padding,)
-	banner = banner % (
-		title,
-		" " + subtitle if subtitle is not None else ""
-	)
-
-	if color == True:
-		colors = []
-		for color in banner_colors:
-			colors.append (ansiColor (**color))
-		colors = tuple (colors)
+	# Without banner lines the title is all there is to show
+	if len (banner_string) == 0:
+		output (" " * banner_indent + title + (" " + subtitle if subtitle is not None else ""))
 
-		print (banner % colors)
 	else:
-		colors = []
-		for color in banner_colors:
-			colors.append ("")
-		print (banner % colors)
+		banner = banner_string % (padding,)
+		banner = banner % (
+			title,
+			" " + subtitle if subtitle is not None else ""
+		)
+
+		if color == True:
+			colors = []
+			for color in banner_colors:
+				colors.append (ansiColor (**color))
+			colors = tuple (colors)
+
+			output (banner % colors)
+		else:
+			colors = []
+			for color in banner_colors:
+				colors.append ("")
+			output (banner % colors)
 
 	if description is not None and len (description) > 0:
-		print ("")
-		print (textwrap.indent (textwrap.fill (description, width = 76), "    "))
+		output ("")
+		output (textwrap.indent (textwrap.fill (description, width = 76), "    "))
 
 	if urls is not None and len (urls) > 0:
-		print ("")
+		output ("")
 		for url in urls.values ():
-			print (" " * banner_indent + url)
+			output (" " * banner_indent + url)
 
 	if repositories is not None and len (repositories) > 0:
-		print ("")
+		output ("")
 		for repository in repositories.values ():
-			print (" " * banner_indent + repository)
+			output (" " * banner_indent + repository)
 
 	if authors is not None and len (authors) > 0:
-		print ("")
-		print (" " * banner_indent + "Author(s):")
+		output ("")
+		output (" " * banner_indent + "Author(s):")
 		for author in authors:
-			print (" " * banner_indent * 2 + "%s <%s>" % (author ["name"], author ["email"]))
+			output (" " * banner_indent * 2 + "%s <%s>" % (author ["name"], author ["email"]))
 
 	if contributors is not None and len (contributors) > 0:
-		print ("")
-		print (" " * banner_indent + "Contributor(s):")
+		output ("")
+		output (" " * banner_indent + "Contributor(s):")
 		for contributor in contributors:
-			print (" " * banner_indent * 2 + "%s <%s>" % (contributor ["name"], contributor ["email"]))
+			output (" " * banner_indent * 2 + "%s <%s>" % (contributor ["name"], contributor ["email"]))
+
+# ==============================================================================
+
+SINK_FLUSH_INTERVAL = 0.5
+SINK_BUFFER_LIMIT = 16777216
+SINK_KEEP = 5
+
+SINKS = {
+	"condition": threading.Condition (threading.Lock ()),
+	"lock": threading.Lock (),
+	"pending": {},
+	"size": 0,
+	"files": {},
+	"thread": None
+}
+
+def sinkWrite (sink:dict, service:str, lines:list[str]):
+	if OUTPUT ["format"] == "json":
+		records = logRecords (service, "output", lines)
+	else:
+		stamp = logTimestamp ()
+		records = [stamp + " " + line for line in lines]
+	data = "".join ([record + "\n" for record in records]).encode ("utf8", errors = "replace")
+
+	with SINKS ["condition"]:
+		if SINKS ["thread"] is None:
+			SINKS ["thread"] = threading.Thread (target = sinkRun, name = "sinks", daemon = True)
+			SINKS ["thread"].start ()
+
+		# Nobody ever waits for the disk, lines it cannot keep up with are
+		# dropped and counted
+		if SINKS ["size"] + len (data) > SINK_BUFFER_LIMIT:
+			METRICS ["log-file-dropped"][service] = METRICS ["log-file-dropped"].get (service, 0) + len (lines)
+			return
+
+		pending = SINKS ["pending"].setdefault (sink ["path"], {"sink": sink, "chunks": []})
+		pending ["sink"] = sink
+		pending ["chunks"].append (data)
+		SINKS ["size"] += len (data)
+		SINKS ["condition"].notify ()
+
+def sinkTake () -> dict:
+	with SINKS ["condition"]:
+		pending = SINKS ["pending"]
+		SINKS ["pending"] = {}
+		SINKS ["size"] = 0
+
+	return pending
+
+def sinkRotate (sink:dict):
+	path = sink ["path"]
+	suffix = ".gz" if sink ["compress"] == True else ""
+
+	# The oldest one is overwritten by the next oldest
+	for index in range (sink ["keep"] - 1, 0, -1):
+		try:
+			os.replace ("%s.%i%s" % (path, index, suffix), "%s.%i%s" % (path, index + 1, suffix))
+		except FileNotFoundError:
+			pass
+
+	if sink ["compress"] == False:
+		os.replace (path, "%s.1" % (path,))
+		return
+
+	temporary = "%s.1.gz.tmp" % (path,)
+	with open (path, "rb") as source, gzip.open (temporary, "wb") as target:
+		shutil.copyfileobj (source, target, 1048576)
+	os.replace (temporary, "%s.1.gz" % (path,))
+	os.unlink (path)
+
+def sinkAppend (sink:dict, data:bytes):
+	path = sink ["path"]
+
+	if (current := SINKS ["files"].get (path)) is None:
+		current = SINKS ["files"][path] = {
+			"file": open (path, "ab"),
+			"opened": time.time ()
+		}
+
+	file = current ["file"]
+	file.write (data)
+	file.flush ()
+
+	if (
+		(sink ["max-size"] is not None and file.tell () >= sink ["max-size"]) or
+		(sink ["max-age"] is not None and time.time () - current ["opened"] >= sink ["max-age"])
+	):
+		file.close ()
+		del (SINKS ["files"][path])
+		sinkRotate (sink)
+
+def sinkFlush (pending:dict):
+	for path, entry in pending.items ():
+		try:
+			sinkAppend (entry ["sink"], b"".join (entry ["chunks"]))
+		except OSError as err:
+			warning ("Cannot write log file %s: %s" % (path, err.strerror))
+
+def sinkRun ():
+	while True:
+		with SINKS ["condition"]:
+			while SINKS ["size"] == 0:
+				SINKS ["condition"].wait ()
+
+		# Lines gathered for a while go out in one large write per file
+		time.sleep (SINK_FLUSH_INTERVAL)
+
+		with SINKS ["lock"]:
+			sinkFlush (sinkTake ())
+
+def sinkExit ():
+	# A disk stuck on a write must not keep the supervisor from exiting
+	if not SINKS ["lock"].acquire (timeout = OUTPUT_FLUSH_TIMEOUT):
+		return
+
+	try:
+		sinkFlush (sinkTake ())
+		for current in SINKS ["files"].values ():
+			current ["file"].close ()
+		SINKS ["files"] = {}
+	finally:
+		SINKS ["lock"].release ()
+
+atexit.register (sinkExit)
+
+# ==============================================================================
+
+PUMP_READ_SIZE = 65536
+PUMP_LINE_LIMIT = 65536
+PUMP_DRAIN_TIMEOUT = 1.0
+PUMP_SOURCE_LIMIT = OUTPUT_BUFFER_LIMIT // 4
+PUMP_SUMMARY_INTERVAL = 5.0
+PUMP_OVERFLOW = ("block", "drop")
+
+PUMP = {
+	"lock": threading.Lock (),
+	"selector": None,
+	"thread": None,
+	"wakeup": None,
+	"pending": []
+}
+
+def pumpStart ():
+	with PUMP ["lock"]:
+		if PUMP ["thread"] is not None:
+			return
+
+		PUMP ["wakeup"] = os.pipe ()
+		os.set_blocking (PUMP ["wakeup"][0], False)
+		os.set_blocking (PUMP ["wakeup"][1], False)
+
+		PUMP ["selector"] = selectors.DefaultSelector ()
+		PUMP ["selector"].register (PUMP ["wakeup"][0], selectors.EVENT_READ, None)
+
+		PUMP ["thread"] = threading.Thread (target = pumpRun, name = "pump", daemon = True)
+		PUMP ["thread"].start ()
+
+def pumpRegister (
+	name:str,
+	stream:object,
+	watch:dict = None,
+	rate:float = None,
+	burst:int = None,
+	overflow:str = "block",
+	sink:dict = None
+) -> threading.Event:
+	drained = threading.Event ()
+
+	if stream is None:
+		drained.set ()
+		return drained
+
+	pumpStart ()
+
+	os.set_blocking (stream.fileno (), False)
+	with PUMP ["lock"]:
+		PUMP ["pending"].append ({
+			"name": name,
+			"stream": stream,
+			"partial": bytearray (),
+			"drained": drained,
+			"watch": watch,
+			"rate": rate,
+			"burst": burst if burst is not None or rate is None else max (1, math.ceil (rate)),
+			"tokens": 0.0,
+			"updated": None,
+			"overflow": overflow,
+			"sink": sink,
+			"generation": None,
+			"buffered": 0,
+			"suppressed": 0,
+			"summary-at": None
+		})
+
+	try:
+		os.write (PUMP ["wakeup"][1], b"\0")
+	except BlockingIOError:
+		pass
+
+	return drained
+
+def pumpPressure (source:dict) -> bool:
+	# Everything buffered is written out at once, so a new generation means
+	# whatever this source had in there is gone
+	if source ["generation"] != OUTPUT ["generation"]:
+		source ["generation"] = OUTPUT ["generation"]
+		source ["buffered"] = 0
+
+	return source ["buffered"] > PUMP_SOURCE_LIMIT or OUTPUT ["size"] > OUTPUT_BUFFER_LIMIT
+
+def pumpSuppress (source:dict, count:int, now:float):
+	if count == 0:
+		return
+
+	if source ["suppressed"] == 0:
+		source ["summary-at"] = now + PUMP_SUMMARY_INTERVAL
+	source ["suppressed"] += count
+	METRICS ["log-suppressed"][source ["name"]] = METRICS ["log-suppressed"].get (source ["name"], 0) + count
+
+def pumpSummary (source:dict):
+	if source ["suppressed"] == 0:
+		return
+
+	summary = "%i line(s) suppressed" % (source ["suppressed"],)
+	if OUTPUT ["format"] == "json":
+		output (*logRecords (source ["name"], "warning", [summary]))
+	else:
+		message (source ["name"], summary, ANSI_WARNING)
+	source ["suppressed"] = 0
+	source ["summary-at"] = None
+
+def pumpLines (source:dict, lines:list[bytes]):
+	_lines = [
+		str (line [0:-1] if line [-1:] == b"\r" else line, "utf8", errors = "replace")
+		for line in lines
+	]
+	METRICS ["log-lines"][source ["name"]] = METRICS ["log-lines"].get (source ["name"], 0) + len (_lines)
+
+	# Readiness is decided on everything the service wrote, whatever ends up
+	# being shown
+	if (watch := source ["watch"]) is not None and not watch ["event"].is_set ():
+		for line in _lines:
+			if watch ["pattern"].search (line) is not None:
+				watch ["event"].set ()
+				break
+
+	# Files get every line, limits only protect the shared output
+	if source ["sink"] is not None:
+		sinkWrite (source ["sink"], source ["name"], _lines)
+
+	now = time.monotonic ()
+
+	# A token bucket, the first lines of a burst are kept and the rest only
+	# counted
+	if source ["rate"] is not None:
+		if source ["updated"] is None:
+			source ["tokens"] = source ["burst"]
+		else:
+			source ["tokens"] = min (source ["burst"], source ["tokens"] + (now - source ["updated"]) * source ["rate"])
+		source ["updated"] = now
+
+		allowed = min (len (_lines), int (source ["tokens"]))
+		source ["tokens"] -= allowed
+		pumpSuppress (source, len (_lines) - allowed, now)
+		_lines = _lines [0:allowed]
+
+	if source ["overflow"] == "drop" and pumpPressure (source):
+		pumpSuppress (source, len (_lines), now)
+		_lines = []
+
+	if len (_lines) == 0:
+		return
+
+	messageLines (source ["name"], _lines)
+	source ["buffered"] += sum ([len (line) + 1 for line in _lines])
+
+	if source ["summary-at"] is not None and source ["summary-at"] <= now:
+		pumpSummary (source)
+
+def lineSplit (partial:bytearray, data:bytes) -> list[bytes]:
+	# Only the new data can contain the end of the last complete line
+	offset = len (partial)
+	partial += data
+	end = partial.rfind (b"\n", offset)
+
+	lines = []
+	if end >= 0:
+		lines = bytes (partial [0:end]).split (b"\n")
+		del partial [0:end + 1]
+
+	if len (partial) >= PUMP_LINE_LIMIT:
+		lines.append (bytes (partial))
+		partial.clear ()
+
+	return lines
+
+def pumpRead (source:dict, fd:int) -> bool:
+	try:
+		data = os.read (fd, PUMP_READ_SIZE)
+	except BlockingIOError:
+		return True
+	except OSError:
+		data = b""
+
+	partial = source ["partial"]
+
+	if len (data) == 0:
+		if len (partial) > 0:
+			pumpLines (source, [bytes (partial)])
+			partial.clear ()
+		pumpSummary (source)
+		return False
+
+	if len (lines := lineSplit (partial, data)) > 0:
+		pumpLines (source, lines)
+
+	return True
+
+def pumpRun ():
+	selector = PUMP ["selector"]
+	sources = {}
+	paused = {}
+
+	# Sources are held back one by one instead
+	OUTPUT_LOCAL.unbounded = True
+
+	while True:
+		# Paused sources are checked on every flush, summaries are due a while
+		# after the first line they left out
+		timeout = None
+		if len (paused) > 0:
+			timeout = OUTPUT_FLUSH_INTERVAL
+		for source in sources.values ():
+			if source ["summary-at"] is not None:
+				remaining = max (0, source ["summary-at"] - time.monotonic ())
+				timeout = remaining if timeout is None else min (timeout, remaining)
+
+		for key, _ in selector.select (timeout):
+			if key.data is None:
+				try:
+					while len (os.read (key.fd, 4096)) > 0:
+						pass
+				except BlockingIOError:
+					pass
+
+				with PUMP ["lock"]:
+					pending = PUMP ["pending"]
+					PUMP ["pending"] = []
+
+				for source in pending:
+					sources [source ["stream"].fileno ()] = source
+					selector.register (source ["stream"].fileno (), selectors.EVENT_READ, source)
+
+				continue
+
+			source = key.data
+			if pumpRead (source, key.fd) == False:
+				selector.unregister (key.fd)
+				del (sources [key.fd])
+				source ["stream"].close ()
+				source ["drained"].set ()
+
+			# Only this source stops being read, its pipe fills up and its
+			# writes block, the others carry on
+			elif source ["overflow"] == "block" and pumpPressure (source):
+				selector.unregister (key.fd)
+				paused [key.fd] = source
+
+		for fd, source in list (paused.items ()):
+			if not pumpPressure (source):
+				del (paused [fd])
+				selector.register (fd, selectors.EVENT_READ, source)
+
+		now = time.monotonic ()
+		for source in sources.values ():
+			if source ["summary-at"] is not None and source ["summary-at"] <= now:
+				pumpSummary (source)
+
+# ==============================================================================
+
+SPAWN = {
+	"backend": "auto",
+	"setpriv": shutil.which ("setpriv"),
+	"lock": threading.Lock (),
+	"children": {}
+}
+
+class SpawnedProcess:
+	# The part of subprocess.Popen the supervisor uses, for children started
+	# with os.posix_spawn
+
+	__slots__ = ("args", "pid", "stdout", "returncode", "lock")
+
+	def __init__ (self, args:list[str], pid:int, stdout:object):
+		self.args = args
+		self.pid = pid
+		self.stdout = stdout
+		self.returncode = None
+		self.lock = threading.Lock ()
+
+	def reap (self, flags:int) -> int:
+		with self.lock:
+			if self.returncode is not None:
+				return self.returncode
+
+			try:
+				pid, status = os.waitpid (self.pid, flags)
+			except ChildProcessError:
+				# Somebody else reaped it, its status is gone with it
+				self.returncode = 255
+				return self.returncode
+
+			if pid == self.pid:
+				self.returncode = os.waitstatus_to_exitcode (status)
+
+			return self.returncode
+
+	def poll (self) -> int:
+		return self.reap (os.WNOHANG)
+
+	def wait (self, timeout:float = None) -> int:
+		if timeout is None:
+			return self.reap (0)
+
+		# There is no waitpid () with a timeout, so back off like Popen does
+		deadline = time.monotonic () + timeout
+		delay = 0.0005
+		while self.poll () is None:
+			if (remaining := deadline - time.monotonic ()) <= 0:
+				raise subprocess.TimeoutExpired (self.args, timeout)
+			time.sleep (min (delay, remaining))
+			delay = min (delay * 2, 0.05)
+
+		return self.returncode
+
+	def send_signal (self, signal_number:int):
+		if self.poll () is None:
+			os.kill (self.pid, signal_number)
+
+	def terminate (self):
+		self.send_signal (signal.SIGTERM)
+
+	def kill (self):
+		self.send_signal (signal.SIGKILL)
+
+def spawnBackend (workdir:str = None, user:str = None, group:str = None) -> str:
+	# posix_spawn () cannot change directory, Popen vforks for that anyway
+	if SPAWN ["backend"] == "popen" or workdir is not None:
+		return "popen"
+
+	# Popen has to fork () a full copy of the supervisor to drop privileges,
+	# setpriv does it after a cheap posix_spawn () instead
+	if user is not None or group is not None:
+		return "popen" if SPAWN ["setpriv"] is None else "setpriv"
+
+	return "posix_spawn"
+
+def spawnProcess (
+	path:str,
+	args:list[str] = [],
+	workdir:str = None,
+	user:str = None,
+	group:str = None,
+	environment:dict = None,
+	output:bool = True
+) -> object:
+	# Every child leads its own process group, so whatever it starts can be
+	# stopped along with it. Children are registered before the reaper gets a
+	# chance to see them exit
+	if (backend := spawnBackend (workdir, user, group)) == "popen":
+		with SPAWN ["lock"]:
+			process = subprocess.Popen (
+				[path] + args,
+				stdout = subprocess.DEVNULL if not output else subprocess.PIPE,
+				stderr = subprocess.STDOUT,
+				close_fds = True,
+				cwd = workdir,
+				env = environment,
+				user = user,
+				group = group,
+				process_group = 0
+			)
+			SPAWN ["children"][process.pid] = process
+
+		return process
+
+	if environment is None:
+		environment = os.environ
+
+	# Like Popen, a bare command is looked up in the child's own PATH
+	executable = path
+	if os.path.dirname (path) == "":
+		executable = shutil.which (path, path = os.pathsep.join (os.get_exec_path (environment)))
+		if executable is None:
+			raise FileNotFoundError (errno.ENOENT, "No such file or directory", path)
+
+	# The same switches as Popen's user and group, supplementary groups kept
+	argv = [path] + args
+	if backend == "setpriv":
+		# Failing to exec would only show in setpriv's exit code, Popen raises,
+		# so the same errors are raised here before anything is started
+		if not os.path.isfile (executable):
+			raise FileNotFoundError (errno.ENOENT, "No such file or directory", path)
+		if not os.access (executable, os.X_OK):
+			raise PermissionError (errno.EACCES, "Permission denied", path)
+
+		prefix = [SPAWN ["setpriv"]]
+		if user is not None:
+			prefix.append ("--reuid=%i" % (userId (user),))
+		if group is not None:
+			prefix.extend (["--regid=%i" % (groupId (group),), "--keep-groups"])
+		argv = prefix + ["--", executable] + args
+		executable = SPAWN ["setpriv"]
+
+	# Everything the supervisor opens is non-inheritable, so only the standard
+	# streams make it across, as with close_fds
+	if output == True:
+		read_fd, write_fd = os.pipe ()
+	else:
+		read_fd, write_fd = (None, os.open (os.devnull, os.O_WRONLY))
+
+	try:
+		with SPAWN ["lock"]:
+			pid = os.posix_spawn (
+				executable,
+				argv,
+				environment,
+				file_actions = [
+					(os.POSIX_SPAWN_DUP2, write_fd, 1),
+					(os.POSIX_SPAWN_DUP2, write_fd, 2)
+				],
+				setpgroup = 0,
+				setsigdef = (signal.SIGPIPE, signal.SIGXFSZ)
+			)
+			process = SpawnedProcess ([path] + args, pid, None if read_fd is None else os.fdopen (read_fd, "rb", buffering = 0))
+			SPAWN ["children"][pid] = process
+	except BaseException:
+		if read_fd is not None:
+			os.close (read_fd)
+		raise
+	finally:
+		os.close (write_fd)
+
+	return process
+
+def processSignal (process:object, signal_number:int):
+	# The whole group is signalled, it outlives its leader for as long as
+	# anything the child started is still in it
+	try:
+		os.killpg (process.pid, signal_number)
+	except ProcessLookupError:
+		pass
+	except PermissionError:
+		# A child that dropped privileges can start something that cannot be
+		# signalled, the child itself always can
+		if process.poll () is None:
+			os.kill (process.pid, signal_number)
 
 # ==============================================================================
 
@@ -314,16 +1066,7 @@ def hostProcess (
 	output:bool = True
 ) -> object:
 	try:
-		process = subprocess.Popen (
-			[path] + args,
-			stdout = subprocess.DEVNULL if not output else subprocess.PIPE,
-			stderr = subprocess.STDOUT,
-			close_fds = True,
-			cwd = workdir,
-			env = environment,
-			user = user,
-			group = group
-		)
+		process = spawnProcess (path, args, workdir, user, group, environment, output)
 	except OSError as err:
 		raise err
 	except ValueError as err:
@@ -331,20 +1074,11 @@ def hostProcess (
 
 	return process
 
-def hostProcessPipe (service_name:str, service:dict):
-	while True:
-		line = service ["process"].stdout.readline ()
-		line = str (line, "utf8")
-
-		if line != "":
-			while line [len (line) - 1:] == "\n":
-				line = line [0:-1]
-			message (service_name, line)
-		else:
-			return
-
 # ==============================================================================
 
+EXEC_TAIL_LINES = 50
+EXEC_POLL_INTERVAL = 0.1
+
 def execProcess (
 	path:str,
 	args:list[str] = [],
@@ -352,39 +1086,86 @@ def execProcess (
 	user:str = None,
 	group:str = None,
 	environment:dict = None,
-	output:bool = True
+	output:bool = True,
+	timeout:float = None,
+	tail:int = EXEC_TAIL_LINES
 ) -> int:
 	try:
-		process = subprocess.Popen (
-			[path] + args,
-			stdout = subprocess.DEVNULL if not output else subprocess.PIPE,
-			stderr = subprocess.STDOUT,
-			close_fds = True,
-			cwd = workdir,
-			env = environment,
-			user = user,
-			group = group
-		)
+		# Output is always piped so a quiet task can still show its last lines
+		# when it fails
+		process = spawnProcess (path, args, workdir, user, group, environment, True)
 	except OSError as err:
 		raise err
 	except ValueError as err:
 		raise err
 
-	while True:
-		if (retcode := process.poll ()) is not None:
-			return retcode
-		line = process.stdout.readline ()
-		line = str (line, "utf8")
+	deadline = None if timeout is None else time.monotonic () + timeout
+	timed_out = False
+	lines_tail = collections.deque (maxlen = tail)
+	partial = bytearray ()
+
+	def emit (lines:list[bytes]):
+		_lines = [
+			str (line [0:-1] if line [-1:] == b"\r" else line, "utf8", errors = "replace")
+			for line in lines
+		]
+		lines_tail.extend (_lines)
+		if output == True:
+			wrapOutput ("\n".join (_lines))
+
+	fd = process.stdout.fileno ()
+	with selectors.DefaultSelector () as selector:
+		selector.register (fd, selectors.EVENT_READ)
+
+		drain_deadline = None
+		while True:
+			now = time.monotonic ()
+			remaining = None if deadline is None else deadline - now
+			if remaining is not None and remaining <= 0:
+				timed_out = True
+				break
 
-		if line != "":
-			while line [len (line) - 1:] == "\n":
-				line = line [0:-1]
-			wrapOutput (line)
+			# Something the task left running in the background can keep the
+			# pipe open for ever, so once the task itself has exited the rest
+			# only gets a moment to be read
+			if drain_deadline is None and process.poll () is not None:
+				drain_deadline = now + PUMP_DRAIN_TIMEOUT
+			if drain_deadline is not None and now >= drain_deadline:
+				break
 
-	while True:
-		if (retcode := process.poll ()) is not None:
-			return retcode
-		time.sleep (0.05)
+			wait = EXEC_POLL_INTERVAL if drain_deadline is None else drain_deadline - now
+			if len (selector.select (wait if remaining is None else min (wait, remaining))) == 0:
+				continue
+
+			data = os.read (fd, PUMP_READ_SIZE)
+			if len (data) == 0:
+				break
+
+			if len (lines := lineSplit (partial, data)) > 0:
+				emit (lines)
+
+	if len (partial) > 0:
+		emit ([bytes (partial)])
+	process.stdout.close ()
+
+	# The pipe can close before the process exits, so keep honouring the timeout
+	if timed_out == False:
+		try:
+			process.wait (None if deadline is None else max (0, deadline - time.monotonic ()))
+		except subprocess.TimeoutExpired:
+			timed_out = True
+
+	if timed_out == True:
+		processSignal (process, signal.SIGKILL)
+		wrapOutput ("Timed out after %.1fs" % (timeout,))
+
+	retcode = process.wait ()
+
+	if retcode != 0 and output == False and len (lines_tail) > 0:
+		wrapOutput ("Last %i line(s) of output:" % (len (lines_tail),))
+		wrapOutput ("\n".join (lines_tail))
+
+	return retcode
 
 # ------------------------------------------------------------------------------
 
@@ -398,16 +1179,7 @@ def runTask (
 	output:bool = True
 ) -> object:
 	try:
-		process = subprocess.Popen (
-			[path] + args,
-			stdout = subprocess.DEVNULL if not output else subprocess.PIPE,
-			stderr = subprocess.STDOUT,
-			close_fds = True,
-			cwd = workdir,
-			env = environment,
-			user = user,
-			group = group
-		)
+		process = spawnProcess (path, args, workdir, user, group, environment, output)
 	except OSError as err:
 		raise err
 	except ValueError as err:
@@ -415,61 +1187,263 @@ def runTask (
 
 	return process
 
-def runTaskPipe (periodic_name:str, periodic:dict):
-	while True:
-		line = periodic ["process"].stdout.readline ()
-		line = str (line, "utf8")
+# ==============================================================================
 
-		if line != "":
-			while line [len (line) - 1:] == "\n":
-				line = line [0:-1]
-			message (periodic_name, line)
-		else:
-			return
+ENVIRONMENT = {
+	"base": None
+}
 
-# ------------------------------------------------------------------------------
+def environmentBase (defaults:dict) -> dict:
+	# The process environment wins over the configured defaults
+	base = {key: value for key, value in defaults.items () if value is not None}
+	base.update (os.environ)
+	ENVIRONMENT ["base"] = base
 
-def fillTemplate (task:dict, environment:dict = {}):
-	def getReplacement (match:object) -> str:
-		key = match.group (1).upper ()
+	return base
 
-		default = None
-		for default_key, default_value in environment.items ():
-			if key == default_key.upper ():
-				default = default_value
-				break
+def environmentLayer (overrides:dict = None) -> dict:
+	# Without overrides every child shares the one base, otherwise it gets
+	# its own copy with them on top, a null value removing a variable
+	if overrides is None or len (overrides) == 0:
+		return ENVIRONMENT ["base"]
 
-		if os.getenv (key) is None and default is None:
-			raise KeyError ("Referenced environment variable has no value or default: %s" % (key,))
-		elif os.getenv (key) is None and default is not None:
-			return default
-		elif os.getenv (key) is not None:
-			return os.getenv (key)
+	environment = {**ENVIRONMENT ["base"], **overrides}
+	for key, value in overrides.items ():
+		if value is None:
+			del (environment [key])
 
-	wrapOutput ("read %s" % (task ["source"],))
-	with open (task ["source"], "r") as file:
-		content = file.read ()
-	wrapOutput ("   Read")
+	return environment
+
+def environmentWrite (path:str, defaults:dict) -> bool:
+	content = "".join ([
+		"%s=%s\n" % (key, shlex.quote (ENVIRONMENT ["base"][key]))
+		for key in defaults.keys () if key in ENVIRONMENT ["base"]
+	])
+	content = bytes (content, "utf8")
+
+	try:
+		with open (path, "rb") as file:
+			if file.read () == content:
+				return False
+	except FileNotFoundError:
+		pass
+
+	fileReplace (path, content)
+
+	return True
+
+# ==============================================================================
+
+TEMPLATE_PATTERN = re.compile (rb"(?i)%%([a-z_]+)%%")
+TEMPLATE_PARTIAL = re.compile (rb"(?i)%(?:%[a-z_]*%?)?\Z")
+TEMPLATE_CACHE = {}
+TEMPLATE_CHUNK_SIZE = 1048576
+TEMPLATE_STREAM_THRESHOLD = 16777216
+
+UMASK = os.umask (0)
+os.umask (UMASK)
+
+def environmentIndex () -> dict:
+	# Placeholders are looked up upper-cased in the same base environment
+	# children get, where the process environment already wins over the
+	# configured defaults
+	return {key.upper (): value for key, value in ENVIRONMENT ["base"].items ()}
+
+def fileDigest (path:str) -> str:
+	_hash = hashlib.sha256 ()
+
+	try:
+		with open (path, "rb") as file:
+			while len (chunk := file.read (1048576)) > 0:
+				_hash.update (chunk)
+	except FileNotFoundError:
+		return None
 
-	content = re.sub (r"(?i)%%([a-z_]+)%%", getReplacement, content)
+	return _hash.hexdigest ().lower ()
+
+def templateCompile (path:str) -> list:
+	stat = os.stat (path)
+	cache_key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+	if (segments := TEMPLATE_CACHE.get (cache_key)) is not None:
+		return segments
+
+	with open (path, "rb") as file:
+		content = file.read ()
 
-	wrapOutput ("write %s" % (task ["target"]["path"]))
-	with open (task ["target"]["path"], "w") as file:
+	# Literal text is kept as bytes, placeholders as upper-cased names
+	segments = []
+	position = 0
+	for match in TEMPLATE_PATTERN.finditer (content):
+		if match.start () > position:
+			segments.append (content [position:match.start ()])
+		segments.append (str (match.group (1), "ascii").upper ())
+		position = match.end ()
+	if position < len (content):
+		segments.append (content [position:])
+
+	TEMPLATE_CACHE [cache_key] = segments
+	return segments
+
+def templateValue (key:str, environment:dict) -> bytes:
+	if (value := environment.get (key)) is None:
+		raise KeyError ("Referenced environment variable has no value or default: %s" % (key,))
+
+	return bytes (str (value), "utf8")
+
+def templateRender (segments:list, environment:dict) -> bytes:
+	return b"".join ([
+		segment if isinstance (segment, bytes) else templateValue (segment, environment)
+		for segment in segments
+	])
+
+def fileAttributes (path:str, uid:int = -1, gid:int = -1, permissions:int = None) -> tuple[int, int, int]:
+	# Without explicit settings a replacement keeps what the old file had,
+	# like rewriting it in place would
+	try:
+		stat = os.stat (path)
+		uid = stat.st_uid if uid == -1 else uid
+		gid = stat.st_gid if gid == -1 else gid
+		permissions = stat.st_mode & 0o7777 if permissions is None else permissions
+	except FileNotFoundError:
+		permissions = 0o666 & ~UMASK if permissions is None else permissions
+
+	return (uid, gid, permissions)
+
+def fileTemporary (path:str) -> tuple[int, str]:
+	directory, name = os.path.split (os.path.abspath (path))
+	return tempfile.mkstemp (dir = directory, prefix = ".%s." % (name,))
+
+def fileCommit (file:object, temporary:str, path:str, uid:int, gid:int, permissions:int):
+	file.flush ()
+	if uid != -1 or gid != -1:
+		os.fchown (file.fileno (), uid, gid)
+	os.fchmod (file.fileno (), permissions)
+	os.fsync (file.fileno ())
+	file.close ()
+
+	os.replace (temporary, path)
+
+def fileReplace (path:str, content:bytes, uid:int = -1, gid:int = -1, permissions:int = None):
+	uid, gid, permissions = fileAttributes (path, uid, gid, permissions)
+
+	fd, temporary = fileTemporary (path)
+	file = os.fdopen (fd, "wb")
+	try:
 		file.write (content)
-	wrapOutput ("   Written")
+		fileCommit (file, temporary, path, uid, gid, permissions)
+	except BaseException:
+		file.close ()
+		os.unlink (temporary)
+		raise
+
+def fileEnsure (path:str, uid:int = -1, gid:int = -1, permissions:int = None) -> bool:
+	stat = os.stat (path)
+	changed = False
 
-	if task ["target"]["owner"] is not None and task ["target"]["group"] is not None:
-		wrapOutput ("chown %s:%s %s" % (task ["target"]["owner"], task ["target"]["group"], task ["target"]["path"]))
-		uid = pwd.getpwnam (task ["target"]["owner"]).pw_uid
-		gid = grp.getgrnam (task ["target"]["group"]).gr_gid
-		os.chown (task ["target"]["path"], uid, gid)
-		wrapOutput ("   Ownership set")
+	if (uid != -1 and stat.st_uid != uid) or (gid != -1 and stat.st_gid != gid):
+		os.chown (path, uid, gid)
+		changed = True
 
-	if task ["target"]["permissions"] is not None:
-		wrapOutput ("chmod %s %s" % (task ["target"]["permissions"], task ["target"]["path"]))
-		_permissions = int (task ["target"]["permissions"], 8)
-		os.chmod (task ["target"]["path"], _permissions)
-		wrapOutput ("   Permissions set")
+	if permissions is not None and stat.st_mode & 0o7777 != permissions:
+		os.chmod (path, permissions)
+		changed = True
+
+	return changed
+
+def templateStream (source:str, path:str, environment:dict, uid:int = -1, gid:int = -1, permissions:int = None) -> tuple[bool, int]:
+	def replacement (match:object) -> bytes:
+		return templateValue (str (match.group (1), "ascii").upper (), environment)
+
+	uid, gid, permissions = fileAttributes (path, uid, gid, permissions)
+	_hash = hashlib.sha256 ()
+	size = 0
+
+	fd, temporary = fileTemporary (path)
+	try:
+		with open (source, "rb") as file, os.fdopen (fd, "wb") as target:
+			carry = b""
+			while True:
+				chunk = file.read (TEMPLATE_CHUNK_SIZE)
+				buffer = carry + chunk
+
+				# A placeholder may be cut in half by the chunk boundary, so
+				# whatever could still become one is carried over
+				cut = len (buffer)
+				if len (chunk) > 0:
+					last_end = 0
+					for match in TEMPLATE_PATTERN.finditer (buffer):
+						last_end = match.end ()
+					if (partial := TEMPLATE_PARTIAL.search (buffer, last_end)) is not None:
+						cut = partial.start ()
+
+				rendered = TEMPLATE_PATTERN.sub (replacement, buffer [0:cut])
+				carry = buffer [cut:]
+
+				target.write (rendered)
+				_hash.update (rendered)
+				size += len (rendered)
+
+				if len (chunk) == 0:
+					break
+
+			try:
+				unchanged = os.stat (path).st_size == size and fileDigest (path) == _hash.hexdigest ().lower ()
+			except FileNotFoundError:
+				unchanged = False
+
+			if unchanged == False:
+				fileCommit (target, temporary, path, uid, gid, permissions)
+
+		if unchanged == True:
+			os.unlink (temporary)
+	except BaseException:
+		if os.path.exists (temporary):
+			os.unlink (temporary)
+		raise
+
+	return (unchanged == False, size)
+
+def fillTemplate (task:object, environment:dict = {}):
+	target = task.target
+
+	uid = -1
+	gid = -1
+	if target ["owner"] is not None and target ["group"] is not None:
+		uid = userId (target ["owner"])
+		gid = groupId (target ["group"])
+
+	permissions = None
+	if target ["permissions"] is not None:
+		permissions = int (target ["permissions"], 8)
+
+	stream = task.stream
+	if stream is None:
+		stream = os.stat (task.source).st_size > TEMPLATE_STREAM_THRESHOLD
+
+	# The target is only replaced when the rendered content differs, so
+	# services watching it do not see spurious changes
+	if stream == True:
+		changed, size = templateStream (task.source, target ["path"], environment, uid, gid, permissions)
+
+	else:
+		content = templateRender (templateCompile (task.source), environment)
+		size = len (content)
+
+		try:
+			changed = os.stat (target ["path"]).st_size != size or fileDigest (target ["path"]) != sha256Hex (content)
+		except FileNotFoundError:
+			changed = True
+
+		if changed == True:
+			fileReplace (target ["path"], content, uid, gid, permissions)
+
+	if changed == True:
+		wrapOutput ("%s written (%i bytes)" % (target ["path"], size))
+	elif fileEnsure (target ["path"], uid, gid, permissions):
+		wrapOutput ("%s unchanged, ownership and permissions set" % (target ["path"],))
+	else:
+		wrapOutput ("%s unchanged" % (target ["path"],))
 
 # ------------------------------------------------------------------------------
 
@@ -491,317 +1465,2183 @@ def pathToTree (path:str, owner:str = None, group:str = None, permissions:str =
 
 	return tree
 
-def ensureTree (tree:dict, path:str = ""):
-	for entry_name, entry in tree.items ():
-		wrapOutput ("mkdir %s%s " % (path, entry_name))
-		try:
-			os.mkdir ("%s%s" % (path, entry_name), mode = 0o0755)
-			wrapOutput ("   Created")
-		except FileExistsError as err:
-			wrapOutput ("   Exists")
-
-		if entry.get ("owner") is not None and entry.get ("group") is not None:
-			wrapOutput ("chown %s:%s %s%s" % (entry ["owner"], entry ["group"], path, entry_name))
-			uid = pwd.getpwnam (entry ["owner"]).pw_uid
-			gid = grp.getgrnam (entry ["group"]).gr_gid
-			os.chown ("%s%s" % (path, entry_name), uid, gid)
-			wrapOutput ("   Ownership set")
-
-		if entry.get ("permissions") is not None:
-			wrapOutput ("chmod %s %s%s" % (entry ["permissions"], path, entry_name))
-			_permissions = int (entry ["permissions"], 8)
-			os.chmod ("%s%s" % (path, entry_name), _permissions)
-			wrapOutput ("Permissions set")
-
-		if entry.get ("tree") is not None and isinstance (entry ["tree"], dict):
-			ensureTree (entry ["tree"], "%s%s/" % (path, entry_name))
+@functools.lru_cache (maxsize = None)
+def userId (user:str) -> int:
+	return pwd.getpwnam (user).pw_uid
 
-# ==============================================================================
+@functools.lru_cache (maxsize = None)
+def groupId (group:str) -> int:
+	return grp.getgrnam (group).gr_gid
 
-CONFIG = {}
-SERVICES = {}
-SERVICE_ORDER = []
-PERIODICS = {}
+TREE_WORKERS = 8
 
-# ==============================================================================
+def treeScan (path:str, settings:dict, exclude:set = None) -> tuple[int, int, list[str]]:
+	scanned = 0
+	changed = 0
+	directories = []
 
-def serviceStart (service_name:str, service:dict):
-	_service = {
-		"process": hostProcess (
-			path = service ["path"],
-			args = service ["args"],
-			workdir = service ["workdir"],
-			user = service ["user"],
-			group = service ["group"],
-			#environment = service ["environment"],
-			output = service ["output"]
-		),
-		"thread": None
-	}
-	_service ["thread"] = threading.Thread (
-		target = hostProcessPipe,
-		args = (
-			service_name,
-			_service
-		)
-	)
-	_service ["thread"].start ()
-	SERVICES [service_name] = _service
+	fd = os.open (path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+	try:
+		with os.scandir (fd) as entries:
+			for entry in entries:
+				if exclude is not None and entry.name in exclude:
+					continue
 
-def serviceStop (service_name:str):
-	_service = SERVICES [service_name]
+				scanned += 1
+				stat = entry.stat (follow_symlinks = False)
+				is_directory = entry.is_dir (follow_symlinks = False)
+				is_changed = False
+
+				if (settings ["uid"] != -1 and stat.st_uid != settings ["uid"]) or (settings ["gid"] != -1 and stat.st_gid != settings ["gid"]):
+					os.chown (entry.name, settings ["uid"], settings ["gid"], dir_fd = fd, follow_symlinks = False)
+					is_changed = True
+
+				# Symbolic links have no permissions of their own on Linux
+				permissions = settings ["directory"] if is_directory else settings ["file"]
+				if permissions is not None and not entry.is_symlink () and stat.st_mode & 0o7777 != permissions:
+					os.chmod (entry.name, permissions, dir_fd = fd)
+					is_changed = True
+
+				if is_changed == True:
+					changed += 1
+				if is_directory == True:
+					directories.append (os.path.join (path, entry.name))
+	finally:
+		os.close (fd)
+
+	return (scanned, changed, directories)
+
+def treeRecursive (path:str, entry:dict) -> tuple[int, int]:
+	settings = {
+		"uid": -1 if entry.get ("owner") is None else userId (entry ["owner"]),
+		"gid": -1 if entry.get ("group") is None else groupId (entry ["group"]),
+		"directory": None if entry.get ("permissions") is None else int (entry ["permissions"], 8),
+		"file": None if entry.get ("file-permissions") is None else int (entry ["file-permissions"], 8)
+	}
 
-	if _service ["process"].poll () is None:
-		_service ["process"].send_signal (signal.SIGINT)
-		time.sleep (1)
-		if _service ["process"].poll () is None:
-			_service ["process"].send_signal (signal.SIGINT)
-			time.sleep (1)
-			if _service ["process"].poll () is None:
-				_service ["process"].send_signal (signal.SIGTERM)
-				time.sleep (2)
-				if _service ["process"].poll () is None:
-					_service ["process"].send_signal (signal.SIGKILL)
-					time.sleep (2)
-
-	_service ["process"].wait ()
-	_service ["thread"].join ()
-
-	_service ["thread"] = None
-	_service ["process"] = None
+	# Explicitly configured children keep their own settings
+	exclude = set ((entry.get ("tree") or {}).keys ())
 
-# ------------------------------------------------------------------------------
+	scanned = 0
+	changed = 0
 
-def periodicStart (periodic_name:str, periodic:dict):
-	_periodic = {
-		"process": runTask (
-			path = periodic ["path"],
-			args = periodic ["args"],
-			workdir = periodic ["workdir"],
-			user = periodic ["user"],
-			group = periodic ["group"],
-			#environment = periodic ["environment"],
-			output = periodic ["output"]
-		),
-		"thread": None
-	}
-	_periodic ["thread"] = threading.Thread (
-		target = runTaskPipe,
-		args = (
-			periodic_name,
-			_periodic
-		)
-	)
-	_periodic ["thread"].start ()
+	# Every directory is a job of its own, so wide trees are scanned in
+	# parallel without any worker waiting on another
+	with concurrent.futures.ThreadPoolExecutor (max_workers = TREE_WORKERS) as executor:
+		running = set ([executor.submit (treeScan, path, settings, exclude)])
+		while len (running) > 0:
+			finished, running = concurrent.futures.wait (running, return_when = concurrent.futures.FIRST_COMPLETED)
+			for future in finished:
+				_scanned, _changed, directories = future.result ()
+				scanned += _scanned
+				changed += _changed
+				for directory in directories:
+					running.add (executor.submit (treeScan, directory, settings))
 
-	PERIODICS [
-		periodic_name +
-		(str (time.time ()) if periodic ["allow-multiple"] else "")
-	] = _periodic
+	return (scanned, changed)
 
-def periodicStop (periodic_id:str):
-	_periodic = PERIODICS [periodic_id]
+def treeEnsure (tree:dict, dir_fd:int, counts:dict, path:str = None):
+	for entry_name, entry in tree.items ():
+		counts ["entries"] += 1
+		entry_path = entry_name if path is None else os.path.join (path, entry_name)
 
-	if _periodic ["process"].poll () is None:
-		_periodic ["process"].send_signal (signal.SIGINT)
-		time.sleep (1)
-		if _periodic ["process"].poll () is None:
-			_periodic ["process"].send_signal (signal.SIGINT)
-			time.sleep (1)
-			if _periodic ["process"].poll () is None:
-				_periodic ["process"].send_signal (signal.SIGTERM)
-				time.sleep (2)
-				if _periodic ["process"].poll () is None:
-					_periodic ["process"].send_signal (signal.SIGKILL)
-					time.sleep (2)
+		try:
+			os.mkdir (entry_name, mode = 0o0755, dir_fd = dir_fd)
+			counts ["created"] += 1
+		except FileExistsError:
+			pass
+
+		# Everything below works on the directory's descriptor, so no path is
+		# ever resolved twice
+		fd = os.open (entry_name, os.O_RDONLY | os.O_DIRECTORY, dir_fd = dir_fd)
+		try:
+			stat = os.fstat (fd)
+
+			uid = -1 if entry.get ("owner") is None else userId (entry ["owner"])
+			gid = -1 if entry.get ("group") is None else groupId (entry ["group"])
+			if (uid != -1 and stat.st_uid != uid) or (gid != -1 and stat.st_gid != gid):
+				os.fchown (fd, uid, gid)
+				counts ["owned"] += 1
+
+			if entry.get ("permissions") is not None:
+				permissions = int (entry ["permissions"], 8)
+				if stat.st_mode & 0o7777 != permissions:
+					os.fchmod (fd, permissions)
+					counts ["permitted"] += 1
+
+			if entry.get ("recursive") == True:
+				start = time.monotonic ()
+				scanned, changed = treeRecursive (entry_path, entry)
+				counts ["scanned"] += scanned
+				counts ["changed"] += changed
+				wrapOutput ("%s: %i entries scanned, %i changed (%.3fs)" % (entry_path, scanned, changed, time.monotonic () - start))
+
+			if entry.get ("tree") is not None and isinstance (entry ["tree"], dict):
+				treeEnsure (entry ["tree"], fd, counts, entry_path)
+		finally:
+			os.close (fd)
+
+def ensureTree (tree:dict, path:str = None) -> dict:
+	counts = {
+		"entries": 0,
+		"created": 0,
+		"owned": 0,
+		"permitted": 0,
+		"scanned": 0,
+		"changed": 0
+	}
+	start = time.monotonic ()
 
-	_periodic ["process"].wait ()
-	_periodic ["thread"].join ()
+	dir_fd = None if path is None else os.open (path, os.O_RDONLY | os.O_DIRECTORY)
+	try:
+		treeEnsure (tree, dir_fd, counts, path)
+	finally:
+		if dir_fd is not None:
+			os.close (dir_fd)
+
+	summary = "%i entries, %i created, %i ownership and %i permission changes" % (
+		counts ["entries"],
+		counts ["created"],
+		counts ["owned"],
+		counts ["permitted"]
+	)
+	if counts ["scanned"] > 0:
+		summary += ", %i recursive entries scanned and %i changed" % (counts ["scanned"], counts ["changed"])
+	wrapOutput ("%s (%.3fs)" % (summary, time.monotonic () - start))
 
-	del (PERIODICS [periodic_id])
+	return counts
 
 # ==============================================================================
 
-def signalStop ():
-	notice ("Shutting down")
+STATE_FILE = "state.jsonl"
+STATE_MARKER_PATTERN = re.compile (r"^[0-9a-f]{64}$")
 
-	for service_name in reversed (SERVICE_ORDER):
-		service = SERVICES [service_name]
+STATE = {
+	"lock": threading.Lock (),
+	"entries": {},
+	"lines": 0
+}
 
-		if service ["process"] is not None:
-			notice ("Stopping service: %s" % (service_name))
-			serviceStop (service_name)
-			notice ("Service stopped: %s" % (service_name))
+def statePath () -> str:
+	return "%s/%s" % (STARTUP_STATE_PATH, STATE_FILE)
 
+def stateLoad ():
+	entries = {}
+	lines = 0
+
+	try:
+		with open (statePath (), "r") as file:
+			for line in file:
+				lines += 1
+				try:
+					entry = json.loads (line)
+				except ValueError:
+					# A write cut short by a crash only ever loses that entry
+					continue
+				entries [entry ["key"]] = entry
+	except FileNotFoundError:
+		pass
+
+	with STATE ["lock"]:
+		STATE ["entries"] = entries
+		STATE ["lines"] = lines
+
+def stateInputs (task:object) -> list[str]:
+	inputs = []
+
+	if task.type == "exec":
+		# Scripts are usually either the command itself or its first argument
+		for path in [task.path] + task.args:
+			if isinstance (path, str) and path.startswith ("/") and os.path.isfile (path):
+				inputs.append (path)
+	elif task.type == "template":
+		inputs.append (task.source)
+
+	inputs.extend (task.inputs or [])
+
+	return sorted (set (inputs))
+
+def stateFingerprint (paths:list[str], previous:dict = None) -> dict:
+	fingerprint = {}
+
+	for path in paths:
+		try:
+			stat = os.stat (path)
+		except FileNotFoundError:
+			fingerprint [path] = None
+			continue
+
+		# Content is only hashed again when size or mtime moved
+		known = (previous or {}).get (path)
+		if known is not None and known ["size"] == stat.st_size and known ["mtime"] == stat.st_mtime_ns:
+			digest = known ["sha256"]
+		else:
+			digest = fileDigest (path)
+
+		fingerprint [path] = {
+			"size": stat.st_size,
+			"mtime": stat.st_mtime_ns,
+			"sha256": digest
+		}
+
+	return fingerprint
+
+def stateCheck (task_key:str, task:object) -> tuple[dict, bool]:
+	with STATE ["lock"]:
+		entry = STATE ["entries"].get (task_key)
+
+	fingerprint = stateFingerprint (stateInputs (task), None if entry is None else entry ["inputs"])
+
+	# Marker files from before the state log count as a successful run with
+	# unknown inputs
+	if entry is None:
+		marker = "%s/%s" % (STARTUP_STATE_PATH, task_key)
+		if os.path.exists (marker):
+			stateRecord (task_key, fingerprint, 0.0, "ok")
+			os.unlink (marker)
+			return (fingerprint, True)
+		return (fingerprint, False)
+
+	if entry ["result"] != "ok":
+		return (fingerprint, False)
+
+	digests = lambda inputs: {path: None if value is None else value ["sha256"] for path, value in inputs.items ()}
+	return (fingerprint, digests (fingerprint) == digests (entry ["inputs"]))
+
+def stateRecord (task_key:str, fingerprint:dict, duration:float, result:str):
+	entry = {
+		"key": task_key,
+		"inputs": fingerprint,
+		"duration": round (duration, 6),
+		"result": result,
+		"time": time.time ()
+	}
+
+	with STATE ["lock"]:
+		STATE ["entries"][task_key] = entry
+		STATE ["lines"] += 1
+		with open (statePath (), "a") as file:
+			file.write (json.dumps (entry, separators = (",", ":")) + "\n")
+
+def stateCompact (task_keys:set):
+	with STATE ["lock"]:
+		entries = {task_key: entry for task_key, entry in STATE ["entries"].items () if task_key in task_keys}
+
+		# Superseded and stale entries are only dropped once they add up
+		if STATE ["lines"] > 2 * max (len (entries), 16) or len (entries) < len (STATE ["entries"]):
+			content = "".join ([json.dumps (entry, separators = (",", ":")) + "\n" for entry in entries.values ()])
+			fileReplace (statePath (), bytes (content, "utf8"))
+			STATE ["entries"] = entries
+			STATE ["lines"] = len (entries)
+
+	for name in os.listdir (STARTUP_STATE_PATH):
+		if STATE_MARKER_PATTERN.match (name) is not None:
+			os.unlink ("%s/%s" % (STARTUP_STATE_PATH, name))
+
+# ==============================================================================
+
+STARTUP_TASK_TYPES = ("exec", "template", "tree")
+
+def startupLabel (index:int, task:object) -> str:
+	return task.name or "#%i" % (index + 1,)
+
+def startupDependencies (tasks:list[object]) -> list[set]:
+	problems = []
+	names = {}
+	for index, task in enumerate (tasks):
+		if task.name is not None:
+			if task.name in names:
+				problems.append ("Duplicate startup task name: %s" % (task.name,))
+			names [task.name] = index
+
+	dependencies = []
+	for index, task in enumerate (tasks):
+		if task.needs is not None:
+			needs = set ()
+			for name in task.needs:
+				if name not in names:
+					problems.append ("Startup task %s needs unknown task: %s" % (startupLabel (index, task), name))
+				elif names [name] >= index:
+					problems.append ("Startup task %s needs a later task: %s" % (startupLabel (index, task), name))
+				else:
+					needs.add (names [name])
+
+		# Tasks sharing a group only wait for the tasks before them outside of it
+		elif task.parallel_group is not None:
+			needs = set ([_index for _index in range (index) if tasks [_index].parallel_group != task.parallel_group])
+
+		else:
+			needs = set (range (index))
+
+		dependencies.append (needs)
+
+	if len (problems) > 0:
+		for problem in problems:
+			error (problem)
+		fatal ("Startup tasks cannot be scheduled")
+
+	return dependencies
+
+def startupTask (task:object, environment:dict) -> str:
+	if task.type == "tree":
+		notice ("Creating directory tree: %s" % (task.description,))
+		ensureTree (task.tree)
+		return None
+
+	task_key = task.key
+	fingerprint, current = stateCheck (task_key, task)
+	start = time.monotonic ()
+
+	if task.type == "exec":
+		if task.every_start == False and current == True:
+			notice ("Skipping startup task: %s" % (task.description,))
+			return None
+
+		notice ("Running startup task: %s" % (task.description,))
+		retcode = execProcess (
+			path = task.path,
+			args = task.args,
+			workdir = task.workdir,
+			user = task.user,
+			group = task.group,
+			environment = environmentLayer (task.environment),
+			output = task.output,
+			timeout = task.timeout
+		)
+		if retcode != 0:
+			stateRecord (task_key, fingerprint, time.monotonic () - start, "failed")
+			return "Startup task %s failed with exit code %i" % (task.description, retcode)
+
+	elif task.type == "template":
+		if task.every_start == False and current == True:
+			notice ("Skipping template: %s" % (task.target ["path"],))
+			return None
+
+		notice ("Filling in template: %s" % (task.target ["path"],))
+		fillTemplate (task, environment)
+
+	stateRecord (task_key, fingerprint, time.monotonic () - start, "ok")
+
+	return None
+
+def startupWorker (label:str, task:object, environment:dict, capture:bool) -> str:
+	if capture == True:
+		outputCapture (label)
+
+	start = time.monotonic ()
+	failure = "exception"
+	try:
+		failure = startupTask (task, environment)
+		return failure
+	finally:
+		METRICS ["startup"][label] = {
+			"duration": time.monotonic () - start,
+			"result": "ok" if failure is None else "failed"
+		}
+		if capture == True:
+			outputRelease ()
+
+def startupRun (tasks:list[object], workers:int = None):
+	dependencies = startupDependencies (tasks)
+	environment = environmentIndex ()
+	stateLoad ()
+	workers = max (1, workers or os.cpu_count () or 1)
+
+	pending = list (range (len (tasks)))
+	running = {}
+	done = set ()
+
+	with concurrent.futures.ThreadPoolExecutor (max_workers = workers) as executor:
+		while len (pending) > 0 or len (running) > 0:
+			for index in [index for index in pending if dependencies [index] <= done]:
+				pending.remove (index)
+				task = tasks [index]
+
+				# Only tasks that opted into running alongside others are buffered,
+				# everything else streams its output as before
+				capture = workers > 1 and (task.needs is not None or task.parallel_group is not None)
+				future = executor.submit (startupWorker, startupLabel (index, task), task, environment, capture)
+				future.add_done_callback (lambda _: supervisorWake ())
+				running [future] = index
+
+			# Finished tasks and signals both wake the supervisor
+			supervisorWait ()
+			stopCheck ()
+
+			for future in [future for future in running if future.done ()]:
+				index = running.pop (future)
+				if (failure := future.result ()) is not None:
+					fatal (failure)
+				done.add (index)
+
+	stateCompact (set ([task.key for task in tasks if task.type != "tree"]))
+
+# ==============================================================================
+
+CONFIG = None
+SERVICES = {}
+SERVICE_ORDER = []
+PERIODICS = {}
+
+# ==============================================================================
+
+SUPERVISOR_WAIT_LIMIT = 60.0
+
+WAKEUP_READ = None
+WAKEUP_WRITE = None
+SELECTOR = None
+
+def supervisorInit ():
+	global WAKEUP_READ, WAKEUP_WRITE, SELECTOR
+
+	# Signals (SIGCHLD included) are written to a self-pipe by the interpreter,
+	# which lets the supervisor block in select () until something happens
+	WAKEUP_READ, WAKEUP_WRITE = os.pipe ()
+	os.set_blocking (WAKEUP_READ, False)
+	os.set_blocking (WAKEUP_WRITE, False)
+	signal.set_wakeup_fd (WAKEUP_WRITE, warn_on_full_buffer = False)
+	signal.signal (signal.SIGCHLD, signalHandler)
+
+	SELECTOR = selectors.DefaultSelector ()
+	SELECTOR.register (WAKEUP_READ, selectors.EVENT_READ)
+
+def supervisorWait (timeout:float = None) -> set:
+	signals = set ()
+
+	# epoll cannot wait for much more than 24 days, and waking up every so
+	# often lets the caller notice the wall clock jumping
+	if timeout is not None:
+		timeout = min (max (0, timeout), SUPERVISOR_WAIT_LIMIT)
+
+	for key, _ in SELECTOR.select (timeout):
+		if key.fd != WAKEUP_READ:
+			continue
+
+		while True:
+			try:
+				data = os.read (WAKEUP_READ, 4096)
+			except BlockingIOError:
+				break
+			if len (data) == 0:
+				break
+			signals.update (data)
+
+	return signals
+
+def supervisorWake ():
+	try:
+		os.write (WAKEUP_WRITE, b"\0")
+	except BlockingIOError:
+		# The pipe is full, so the supervisor is going to wake up anyway
+		pass
+
+# ------------------------------------------------------------------------------
+
+PR_SET_CHILD_SUBREAPER = 36
+ORPHAN_STOP_TIMEOUT = 2.0
+
+REAP = False
+
+def supervisorSubreaper () -> bool:
+	# As PID 1 orphans are ours anyway, otherwise they would skip the
+	# supervisor and go to whatever init there is
+	try:
+		libc = ctypes.CDLL (None, use_errno = True)
+		if libc.prctl (PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+			raise OSError (ctypes.get_errno (), os.strerror (ctypes.get_errno ()))
+	except (OSError, AttributeError) as err:
+		warning ("Cannot become a child subreaper: %s" % (str (err),))
+		return False
+
+	return True
+
+def childrenReap () -> int:
+	reaped = 0
+
+	with SPAWN ["lock"]:
+		children = SPAWN ["children"]
+		for pid, process in list (children.items ()):
+			if process.returncode is not None:
+				del (children [pid])
+
+		# Exits are only peeked at, children that are tracked are reaped
+		# through their own objects so their exit codes are kept
+		while True:
+			try:
+				result = os.waitid (os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+			except ChildProcessError:
+				break
+			if result is None:
+				break
+
+			if (process := children.get (result.si_pid)) is not None:
+				# Another thread is busy reaping it, whatever exited after it
+				# is left for the next time
+				if process.poll () is None:
+					break
+				del (children [result.si_pid])
+				continue
+
+			os.waitpid (result.si_pid, os.WNOHANG)
+			reaped += 1
+
+	METRICS ["orphans-reaped"] += reaped
+	return reaped
+
+def childrenOrphans () -> list[int]:
+	with SPAWN ["lock"]:
+		tracked = set ([pid for pid, process in SPAWN ["children"].items () if process.returncode is None])
+
+	return [pid for pid in resourceProcesses ()[1].get (os.getpid (), []) if pid not in tracked]
+
+def childrenStop (timeout:float = ORPHAN_STOP_TIMEOUT):
+	childrenReap ()
+	if len (orphans := childrenOrphans ()) == 0:
+		return
+
+	# What outlived the services that started it is asked to stop too, then
+	# killed, so nothing outlives the supervisor
+	notice ("Stopping %i orphaned process(es)" % (len (orphans),))
+	for _signal in (signal.SIGTERM, signal.SIGKILL):
+		for pid in orphans:
+			try:
+				os.kill (pid, _signal)
+			except ProcessLookupError:
+				pass
+
+		deadline = time.monotonic () + timeout
+		while len (orphans) > 0 and time.monotonic () < deadline:
+			supervisorWait (0.05)
+			childrenReap ()
+			orphans = childrenOrphans ()
+
+		if len (orphans) == 0:
+			break
+
+# ==============================================================================
+
+STOP_SIGNALS = ["SIGINT", "SIGINT", "SIGTERM"]
+STOP_TIMEOUT = 4.0
+
+def signalParse (value:(str | int)) -> signal.Signals:
+	if isinstance (value, int):
+		return signal.Signals (value)
+
+	value = value.upper ()
+	if not value.startswith ("SIG"):
+		value = "SIG" + value
+
+	return signal.Signals [value]
+
+def stopEntry (kind:str, name:str, process:object, definition:object) -> dict:
+	signals = definition.stop_signal
+	if not isinstance (signals, list):
+		signals = [signals]
+
+	return {
+		"kind": kind,
+		"name": name,
+		"process": process,
+		"signals": [signalParse (_signal) for _signal in signals],
+		"timeout": definition.stop_timeout,
+		"start": time.monotonic (),
+		"sent": 0,
+		"killed": False
+	}
+
+def processesStep (running:list[dict]) -> float:
+	wake = None
+
+	for entry in list (running):
+		process = entry ["process"]
+		elapsed = time.monotonic () - entry ["start"]
+
+		if process.poll () is not None:
+			running.remove (entry)
+			notice ("%s stopped: %s (%.3fs)" % (entry ["kind"], entry ["name"], elapsed))
+
+			# Anything it left behind in its group goes with it
+			processSignal (process, signal.SIGKILL)
+			continue
+
+		# The stop signals are spread evenly over the stop timeout
+		step = entry ["timeout"] / len (entry ["signals"])
+		while entry ["sent"] < len (entry ["signals"]) and elapsed >= entry ["sent"] * step:
+			processSignal (process, entry ["signals"][entry ["sent"]])
+			entry ["sent"] += 1
+
+		if entry ["sent"] < len (entry ["signals"]):
+			deadline = entry ["sent"] * step
+		elif entry ["killed"] == False and elapsed >= entry ["timeout"]:
+			warning ("%s did not stop in time, killing: %s" % (entry ["kind"], entry ["name"]))
+			processSignal (process, signal.SIGKILL)
+			entry ["killed"] = True
+			deadline = None
+		elif entry ["killed"] == False:
+			deadline = entry ["timeout"]
+		else:
+			deadline = None
+
+		if deadline is not None and (wake is None or entry ["start"] + deadline < wake):
+			wake = entry ["start"] + deadline
+
+	return wake
+
+def processesStop (entries:list[dict]):
+	running = list (entries)
+
+	while len (running) > 0:
+		wake = processesStep (running)
+		if len (running) > 0:
+			supervisorWait (None if wake is None else wake - time.monotonic ())
+
+# ==============================================================================
+
+def serviceStart (service_name:str, service:object):
+	ready = service.ready
+
+	_service = {
+		"process": hostProcess (
+			path = service.path,
+			args = service.args,
+			workdir = service.workdir,
+			user = service.user,
+			group = service.group,
+			environment = environmentLayer (service.environment),
+			output = service.output
+		),
+		"definition": service,
+		"state": "running",
+		"restart-at": None,
+		"drained": None,
+		"ready": threading.Event (),
+		"ready-log": threading.Event (),
+		"ready-error": None,
+		"ready-at": None
+	}
+
+	sink = None
+	if service.log_file is not None:
+		sink = {
+			"path": service.log_file,
+			"max-size": service.log_max_size,
+			"max-age": service.log_max_age,
+			"keep": service.log_keep,
+			"compress": service.log_compress
+		}
+
+	watch = None
+	if ready is not None and ready.log is not None:
+		watch = {
+			"pattern": re.compile (ready.log),
+			"event": _service ["ready-log"]
+		}
+
+	_service ["drained"] = pumpRegister (
+		service_name,
+		_service ["process"].stdout,
+		watch,
+		service.log_rate_limit,
+		service.log_rate_burst,
+		service.log_overflow,
+		sink
+	)
+	_service ["started"] = time.time ()
+	SERVICES [service_name] = _service
+
+	if ready is None:
+		_service ["ready-at"] = _service ["started"]
+		_service ["ready"].set ()
+	else:
+		threading.Thread (
+			target = serviceReady,
+			args = (service_name, service, _service),
+			name = "ready-%s" % (service_name,),
+			daemon = True
+		).start ()
+
+def serviceStop (service_name:str):
+	servicesStop ([service_name])
+
+def servicesStop (service_names:list[str]):
+	entries = []
+	for service_name in service_names:
+		_service = SERVICES [service_name]
+		if _service ["process"] is not None and _service ["process"].poll () is None:
+			notice ("Stopping service: %s" % (service_name,))
+			entries.append (stopEntry ("Service", service_name, _service ["process"], _service ["definition"]))
+
+	processesStop (entries)
+
+	drain_deadline = time.monotonic () + PUMP_DRAIN_TIMEOUT
+	for service_name in service_names:
+		_service = SERVICES [service_name]
+		if _service ["drained"] is not None:
+			_service ["drained"].wait (max (0, drain_deadline - time.monotonic ()))
+
+		_service ["drained"] = None
+		_service ["process"] = None
+
+# ------------------------------------------------------------------------------
+
+RESTART_DELAY = 0.1
+RESTART_MAX_DELAY = 30.0
+RESTART_JITTER = 0.1
+RESTART_LIMIT = 10
+RESTART_WINDOW = 60.0
+
+RESTARTS = {}
+
+def restartRecord (service_name:str, service:object) -> tuple[float, int]:
+	now = time.monotonic ()
+	window = service.restart_window
+
+	restarts = RESTARTS.setdefault (service_name, {
+		"rate": 0.0,
+		"updated": now,
+		"history": collections.deque ()
+	})
+
+	# The rate decays with the window as its time constant, so a service that
+	# has been stable for a while starts over at the initial delay
+	restarts ["rate"] = restarts ["rate"] * math.exp (-(now - restarts ["updated"]) / window) + 1
+	restarts ["updated"] = now
+
+	restarts ["history"].append (now)
+	while restarts ["history"][0] < now - window:
+		restarts ["history"].popleft ()
+
+	delay = min (
+		service.restart_max_delay,
+		service.restart_delay * 2 ** (restarts ["rate"] - 1)
+	)
+	jitter = service.restart_jitter
+	delay *= 1 + random.uniform (-jitter, jitter)
+
+	return (delay, len (restarts ["history"]))
+
+def serviceExited (service_name:str, retcode:int):
+	_service = SERVICES [service_name]
+	service = _service ["definition"]
+
+	serviceStop (service_name)
+
+	policy = service.restart
+	if policy == "never" or (policy == "on-failure" and retcode == 0):
+		notice ("Service exited: %s (exit code %i), not restarting" % (service_name, retcode))
+		_service ["state"] = "exited"
+		return
+
+	warning ("Service unexpectedly stopped: %s (exit code %i)" % (service_name, retcode))
+
+	delay, restarts = restartRecord (service_name, service)
+	limit = service.restart_limit
+
+	if limit is not None and restarts > limit:
+		error ("Service %s restarted %i times within %.0fs" % (service_name, restarts - 1, service.restart_window))
+		_service ["state"] = "failed"
+
+		if service.restart_action == "exit":
+			signalStop (1)
+		else:
+			error ("Service marked as failed: %s" % (service_name,))
+		return
+
+	notice ("Restarting service %s in %.3fs" % (service_name, delay))
+	METRICS ["restarts"][service_name] = METRICS ["restarts"].get (service_name, 0) + 1
+	_service ["state"] = "backoff"
+	_service ["restart-at"] = time.monotonic () + delay
+
+# ------------------------------------------------------------------------------
+
+READY_TIMEOUT = 60.0
+READY_INTERVAL = 0.05
+READY_MAX_INTERVAL = 1.0
+READY_CONNECT_TIMEOUT = 1.0
+READY_EXEC_TIMEOUT = 10.0
+
+def readyAddress (address:(str | int | dict)) -> tuple[str, int]:
+	if isinstance (address, int):
+		return ("127.0.0.1", address)
+
+	if isinstance (address, dict):
+		return (address.get ("host", "127.0.0.1"), int (address ["port"]))
+
+	host, _, port = str (address).rpartition (":")
+	return (host.strip ("[]") or "127.0.0.1", int (port))
+
+def readyProbe (service:object, _service:dict) -> bool:
+	ready = service.ready
+
+	if ready.file is not None and not os.path.exists (ready.file):
+		return False
+
+	if ready.log is not None and not _service ["ready-log"].is_set ():
+		return False
+
+	if ready.unix is not None:
+		try:
+			with socket.socket (socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+				sock.settimeout (READY_CONNECT_TIMEOUT)
+				sock.connect (ready.unix)
+		except OSError:
+			return False
+
+	if ready.tcp is not None:
+		try:
+			with socket.create_connection (readyAddress (ready.tcp), timeout = READY_CONNECT_TIMEOUT):
+				pass
+		except OSError:
+			return False
+
+	if ready.exec is not None:
+		probe = hostProcess (
+			path = ready.exec ["path"],
+			args = ready.exec.get ("args", []),
+			workdir = ready.exec.get ("workdir"),
+			user = ready.exec.get ("user"),
+			group = ready.exec.get ("group"),
+			environment = environmentLayer (service.environment),
+			output = False
+		)
+		try:
+			if probe.wait (READY_EXEC_TIMEOUT) != 0:
+				return False
+		except subprocess.TimeoutExpired:
+			processSignal (probe, signal.SIGKILL)
+			probe.wait ()
+			return False
+
+	return True
+
+def serviceReady (service_name:str, service:object, _service:dict):
+	ready = service.ready
+	timeout = ready.timeout
+	interval = ready.interval
+	max_interval = ready.max_interval
+
+	try:
+		while True:
+			if readyProbe (service, _service):
+				_service ["ready-at"] = time.time ()
+				notice ("Service ready: %s (%.3fs)" % (service_name, _service ["ready-at"] - _service ["started"]))
+				break
+
+			if (retcode := _service ["process"].poll ()) is not None:
+				_service ["ready-error"] = "exited with code %i before becoming ready" % (retcode,)
+				break
+
+			if timeout is not None and time.time () - _service ["started"] >= timeout:
+				_service ["ready-error"] = "not ready after %.1fs" % (timeout,)
+				break
+
+			# A log line match ends the wait early, the other probes back off
+			_service ["ready-log"].wait (interval)
+			interval = min (interval * 1.5, max_interval)
+
+	except Exception as err:
+		_service ["ready-error"] = "%s: %s" % (err.__class__.__name__, str (err))
+
+	if _service ["ready-error"] is not None:
+		error ("Service %s %s" % (service_name, _service ["ready-error"]))
+
+	_service ["ready"].set ()
+	supervisorWake ()
+
+# ------------------------------------------------------------------------------
+
+def serviceCycle (services:dict, remaining:set) -> list[str]:
+	visiting = []
+	visited = set ()
+
+	def visit (service_name:str) -> list[str]:
+		if service_name in visiting:
+			return visiting [visiting.index (service_name):] + [service_name]
+		if service_name in visited:
+			return None
+
+		visiting.append (service_name)
+		for needs in services [service_name].needs:
+			if needs in remaining and (cycle := visit (needs)) is not None:
+				return cycle
+		visiting.pop ()
+		visited.add (service_name)
+
+		return None
+
+	for service_name in sorted (remaining):
+		if (cycle := visit (service_name)) is not None:
+			return cycle
+
+	return sorted (remaining)
+
+def serviceLayers (services:dict, problems:list = None) -> list[list[str]]:
+	collect = problems is not None
+	if collect == False:
+		problems = []
+	count = len (problems)
+	dependents = {service_name: [] for service_name in services}
+	waiting = {}
+
+	for service_name, service in services.items ():
+		needs = set (service.needs)
+
+		for _needs in sorted (needs):
+			if _needs not in services:
+				problems.append ("Service %s needs unknown service: %s" % (service_name, _needs))
+			else:
+				dependents [_needs].append (service_name)
+
+		waiting [service_name] = len ([_needs for _needs in needs if _needs in services])
+
+	layers = []
+	layer = [service_name for service_name, count in waiting.items () if count == 0]
+	while len (layer) > 0:
+		layers.append (layer)
+
+		next_layer = []
+		for service_name in layer:
+			for dependent in dependents [service_name]:
+				waiting [dependent] -= 1
+				if waiting [dependent] == 0:
+					next_layer.append (dependent)
+		layer = next_layer
+
+	remaining = set ([service_name for service_name, count in waiting.items () if count > 0])
+	if len (remaining) > 0:
+		problems.append ("Service dependency cycle: %s" % (" -> ".join (serviceCycle (services, remaining)),))
+
+	if len (problems) > count:
+		if collect == True:
+			return None
+		for problem in problems:
+			error (problem)
+		fatal ("Service dependencies cannot be resolved")
+
+	return layers
+
+def serviceStopLayers (services:dict) -> list[list[str]]:
+	# The start layers turned around: the first holds every service nothing
+	# depends on, and a service follows once all of its dependents are in
+	waiting = {service_name: 0 for service_name in services}
+	for service in services.values ():
+		for _needs in set (service.needs):
+			if _needs in waiting:
+				waiting [_needs] += 1
+
+	layers = []
+	layer = [service_name for service_name, count in waiting.items () if count == 0]
+	while len (layer) > 0:
+		layers.append (layer)
+
+		next_layer = []
+		for service_name in layer:
+			for _needs in set (services [service_name].needs):
+				if _needs in waiting:
+					waiting [_needs] -= 1
+					if waiting [_needs] == 0:
+						next_layer.append (_needs)
+		layer = next_layer
+
+	return layers
+
+def servicesStart (services:dict, boot_start:float, service_names:list[str] = None, required:bool = True):
+	def start (service_name:str):
+		service = services [service_name]
+
+		notice ("Starting service: %s (%s)" % (service.description, service_name))
+		serviceStart (service_name, service)
+		SERVICE_ORDER.append (service_name)
+		notice ("Service started: %s (+%.3fs)" % (service_name, SERVICES [service_name]["started"] - boot_start))
+
+	# Dependencies outside of the services being started are already running
+	if service_names is None:
+		service_names = list (services.keys ())
+	pending = {
+		service_name: set (services [service_name].needs) & set (service_names)
+		for service_name in service_names
+	}
+	starting = set ()
+	ready = set ()
+
+	with concurrent.futures.ThreadPoolExecutor (max_workers = max (1, len (service_names))) as executor:
+		while len (pending) > 0 or len (starting) > 0:
+			startable = [service_name for service_name, needs in pending.items () if needs <= ready]
+			for service_name in startable:
+				del (pending [service_name])
+
+			# Everything whose dependencies are ready is started at once
+			for future in [executor.submit (start, service_name) for service_name in startable]:
+				future.result ()
+			starting.update (startable)
+
+			became_ready = [service_name for service_name in starting if SERVICES [service_name]["ready"].is_set ()]
+			for service_name in became_ready:
+				starting.discard (service_name)
+				if SERVICES [service_name]["ready-error"] is not None:
+					if required == True:
+						fatal ("Service %s failed to become ready" % (service_name,))
+					error ("Service %s failed to become ready" % (service_name,))
+				ready.add (service_name)
+
+			if len (startable) == 0 and len (became_ready) == 0:
+				supervisorWait ()
+				stopCheck ()
+
+# ------------------------------------------------------------------------------
+
+PERIODIC_SEQUENCE = itertools.count (1)
+
+def periodicStart (periodic_name:str, periodic:object) -> str:
+	_periodic = {
+		"process": runTask (
+			path = periodic.path,
+			args = periodic.args,
+			workdir = periodic.workdir,
+			user = periodic.user,
+			group = periodic.group,
+			environment = environmentLayer (periodic.environment),
+			output = periodic.output
+		),
+		"name": periodic_name,
+		"definition": periodic,
+		"drained": None,
+		"started": time.monotonic (),
+		"timeout-at": None
+	}
+	_periodic ["drained"] = pumpRegister (periodic_name, _periodic ["process"].stdout)
+
+	if periodic.timeout is not None:
+		_periodic ["timeout-at"] = _periodic ["started"] + periodic.timeout
+
+	periodic_id = "%s#%i" % (periodic_name, next (PERIODIC_SEQUENCE))
+	PERIODICS [periodic_id] = _periodic
+
+	return periodic_id
+
+def periodicStop (periodic_id:str):
+	periodicsStop ([periodic_id])
+
+def periodicsStop (periodic_ids:list[str]):
+	entries = []
+	for periodic_id in periodic_ids:
+		_periodic = PERIODICS [periodic_id]
+		if _periodic ["process"].poll () is None:
+			notice ("Stopping periodic task: %s" % (periodic_id,))
+			entries.append (stopEntry ("Periodic task", periodic_id, _periodic ["process"], _periodic ["definition"]))
+
+	processesStop (entries)
+
+	drain_deadline = time.monotonic () + PUMP_DRAIN_TIMEOUT
+	for periodic_id in periodic_ids:
+		PERIODICS [periodic_id]["drained"].wait (max (0, drain_deadline - time.monotonic ()))
+		del (PERIODICS [periodic_id])
+
+# ------------------------------------------------------------------------------
+
+PERIODIC_QUEUE = collections.deque ()
+PERIODIC_STOPPING = []
+PERIODIC_DELAYED = []
+PERIODIC_DELAYED_SEQUENCE = itertools.count ()
+
+def periodicLimit (periodic:object) -> int:
+	if periodic.max_concurrent is not None:
+		return periodic.max_concurrent
+
+	return None if periodic.allow_multiple == True else 1
+
+def periodicCount (periodic_name:str) -> int:
+	count = len ([True for _periodic_name, _ in PERIODIC_QUEUE if _periodic_name == periodic_name])
+	count += len ([True for _, _, _periodic_name in PERIODIC_DELAYED if _periodic_name == periodic_name])
+	count += len ([True for _periodic in PERIODICS.values () if _periodic ["name"] == periodic_name])
+
+	return count
+
+def periodicFire (periodic_name:str, periodic:object):
+	limit = periodicLimit (periodic)
+	if limit is not None and periodicCount (periodic_name) >= limit:
+		warning ("Periodic still running: %s" % (periodic_name))
+		return
+
+	# Jitter spreads out periodics that share a timing across containers
+	jitter = periodic.jitter
+	if jitter > 0:
+		heapq.heappush (PERIODIC_DELAYED, (time.monotonic () + random.uniform (0, jitter), next (PERIODIC_DELAYED_SEQUENCE), periodic_name))
+	else:
+		PERIODIC_QUEUE.append ((periodic_name, time.monotonic ()))
+
+def periodicsDispatch (periodics:dict, max_concurrent:int = None) -> float:
+	now = time.monotonic ()
+
+	while len (PERIODIC_DELAYED) > 0 and PERIODIC_DELAYED [0][0] <= now:
+		PERIODIC_QUEUE.append ((heapq.heappop (PERIODIC_DELAYED)[2], now))
+
+	while len (PERIODIC_QUEUE) > 0 and (max_concurrent is None or len (PERIODICS) < max_concurrent):
+		periodic_name, queued = PERIODIC_QUEUE.popleft ()
+		periodic = periodics [periodic_name]
+
+		notice ("Starting periodic: %s (%s)" % (periodic.description, periodic_name))
+		periodic_id = periodicStart (periodic_name, periodic)
+		if now - queued >= 0.001:
+			notice ("Periodic started: %s (queued %.3fs)" % (periodic_id, now - queued))
+		else:
+			notice ("Periodic started: %s" % (periodic_id))
+
+	# Overrunning tasks are stopped alongside everything else the supervisor
+	# does, the ended ones are tidied up by the main loop as usual
 	for periodic_id, _periodic in PERIODICS.items ():
-		if _periodic ["process"] is not None:
-			notice ("Stopping periodic task: %s" % (periodic_id))
-			periodicStop (periodic_id)
-			notice ("Periodic task stopped: %s" % (periodic_id))
+		if _periodic ["timeout-at"] is not None and _periodic ["timeout-at"] <= now:
+			warning ("Periodic task timed out: %s" % (periodic_id,))
+			_periodic ["timeout-at"] = None
+			PERIODIC_STOPPING.append (stopEntry ("Periodic task", periodic_id, _periodic ["process"], _periodic ["definition"]))
+
+	wake = processesStep (PERIODIC_STOPPING)
+	if len (PERIODIC_DELAYED) > 0 and (wake is None or PERIODIC_DELAYED [0][0] < wake):
+		wake = PERIODIC_DELAYED [0][0]
+	for _periodic in PERIODICS.values ():
+		if _periodic ["timeout-at"] is not None and (wake is None or _periodic ["timeout-at"] < wake):
+			wake = _periodic ["timeout-at"]
+
+	return wake
+
+# ------------------------------------------------------------------------------
+
+CRON_GRACE = 1.0
+
+SCHEDULE = {
+	"heap": [],
+	"iterators": {}
+}
+
+def scheduleBuild (periodics:dict):
+	heap = []
+	iterators = {}
+	now = datetime.datetime.now ().astimezone ()
+
+	for periodic_name, periodic in periodics.items ():
+		if periodic.timing == "":
+			continue
+
+		# Five fields are the classic minute based syntax, a sixth one adds seconds
+		try:
+			iterator = croniter (periodic.timing, now, ret_type = float)
+		except ValueError as err:
+			fatal ("Invalid timing for periodic %s: %s" % (periodic_name, str (err)))
+
+		iterators [periodic_name] = iterator
+		heap.append ((iterator.get_next (float), periodic_name))
+
+	heapq.heapify (heap)
+	SCHEDULE ["heap"] = heap
+	SCHEDULE ["iterators"] = iterators
+
+def scheduleNext () -> float:
+	if len (SCHEDULE ["heap"]) == 0:
+		return None
+
+	return SCHEDULE ["heap"][0][0]
+
+def scheduleDue (periodics:dict, now:float) -> list[tuple[str, int]]:
+	heap = SCHEDULE ["heap"]
+	due = []
+
+	while len (heap) > 0 and heap [0][0] <= now:
+		fire, periodic_name = heapq.heappop (heap)
+		iterator = SCHEDULE ["iterators"][periodic_name]
+
+		fires = 1
+		latest = fire
+		while (fire := iterator.get_next (float)) <= now:
+			fires += 1
+			latest = fire
+		heapq.heappush (heap, (fire, periodic_name))
+
+		policy = periodics [periodic_name].catch_up
+		late = now - latest > CRON_GRACE
+
+		if policy == "all":
+			runs = fires
+		elif policy == "skip" and late:
+			runs = 0
+		else:
+			runs = 1
+
+		if late or fires > 1:
+			warning ("Periodic %s missed %i run(s), catching up with %i" % (periodic_name, fires - (0 if late else 1), runs))
+
+		if runs > 0:
+			due.append ((periodic_name, runs))
+
+	return due
+
+# ==============================================================================
+
+RESOURCE_INTERVAL = 5.0
+RESOURCE_WINDOW = 6
+RESOURCE_PAGE_SIZE = os.sysconf ("SC_PAGE_SIZE")
+RESOURCE_CLOCK_TICKS = os.sysconf ("SC_CLK_TCK")
+
+RESOURCES = {
+	"services": {},
+	"periodics": {},
+	"thread": None
+}
+
+def resourceProcesses () -> tuple[dict, dict]:
+	# One pass over /proc for the CPU time of everything and the parent to
+	# children map
+	ticks = {}
+	children = {}
+
+	for entry in os.listdir ("/proc"):
+		if not entry.isdigit ():
+			continue
+
+		try:
+			with open ("/proc/%s/stat" % (entry,), "rb") as file:
+				fields = file.read ().rpartition (b")")[2].split ()
+		except OSError:
+			continue
+
+		pid = int (entry)
+		ticks [pid] = int (fields [11]) + int (fields [12])
+		children.setdefault (int (fields [1]), []).append (pid)
+
+	return (ticks, children)
+
+def resourceTree (processes:tuple[dict, dict], pid:int) -> dict:
+	ticks, children = processes
+
+	sample = {
+		"processes": 0,
+		"ticks": 0,
+		"rss": 0,
+		"read": 0,
+		"write": 0
+	}
+
+	pending = [pid]
+	while len (pending) > 0:
+		pid = pending.pop ()
+		if pid not in ticks:
+			continue
+
+		try:
+			with open ("/proc/%i/statm" % (pid,), "rb") as file:
+				rss = int (file.read ().split ()[1]) * RESOURCE_PAGE_SIZE
+		except OSError:
+			# It exited between the listing and now
+			continue
+
+		sample ["processes"] += 1
+		sample ["ticks"] += ticks [pid]
+		sample ["rss"] += rss
+
+		try:
+			with open ("/proc/%i/io" % (pid,), "rb") as file:
+				for line in file:
+					key, _, value = line.partition (b":")
+					if key == b"read_bytes":
+						sample ["read"] += int (value)
+					elif key == b"write_bytes":
+						sample ["write"] += int (value)
+		except OSError:
+			pass
+
+		pending.extend (children.get (pid, []))
+
+	return sample
+
+def resourceUpdate (resources:dict, name:str, sample:dict, now:float) -> dict:
+	resource = resources.setdefault (name, {"samples": collections.deque (maxlen = RESOURCE_WINDOW)})
+	samples = resource ["samples"]
+	samples.append ((now, sample))
+
+	# Rates are taken over the whole window, which smooths out short spikes
+	first_time, first = samples [0]
+	elapsed = now - first_time
+	resource.update ({
+		"processes": sample ["processes"],
+		"rss": sample ["rss"],
+		"cpu": 0.0 if elapsed <= 0 else max (0.0, (sample ["ticks"] - first ["ticks"]) / RESOURCE_CLOCK_TICKS / elapsed * 100),
+		"read-rate": 0.0 if elapsed <= 0 else max (0.0, (sample ["read"] - first ["read"]) / elapsed),
+		"write-rate": 0.0 if elapsed <= 0 else max (0.0, (sample ["write"] - first ["write"]) / elapsed),
+		"full": len (samples) == samples.maxlen
+	})
+
+	return resource
+
+def resourceSample ():
+	now = time.monotonic ()
+	processes = resourceProcesses ()
+
+	# A restarted service starts over with a fresh window
+	services = {}
+	for service_name, _service in list (SERVICES.items ()):
+		if (process := _service ["process"]) is None or process.returncode is not None:
+			continue
+
+		if RESOURCES ["services"].get (service_name, {}).get ("pid") != process.pid:
+			RESOURCES ["services"].pop (service_name, None)
+
+		resource = resourceUpdate (RESOURCES ["services"], service_name, resourceTree (processes, process.pid), now)
+		resource ["pid"] = process.pid
+		services [service_name] = resource
+
+		service = _service ["definition"]
+		if _service ["state"] != "running" or _service.get ("recycle") is not None:
+			continue
+
+		if service.max_rss is not None and resource ["rss"] > service.max_rss:
+			_service ["recycle"] = "using %i bytes of memory, more than %i" % (resource ["rss"], service.max_rss)
+		elif service.max_cpu is not None and resource ["full"] == True and resource ["cpu"] > service.max_cpu:
+			_service ["recycle"] = "using %.1f%% CPU, more than %.1f%%" % (resource ["cpu"], service.max_cpu)
+		else:
+			continue
+
+		supervisorWake ()
+
+	RESOURCES ["services"] = services
+
+	# Runs of the same periodic are summed up under its name
+	periodics = {}
+	for _periodic in list (PERIODICS.values ()):
+		if _periodic ["process"].returncode is not None:
+			continue
+
+		sample = resourceTree (processes, _periodic ["process"].pid)
+		if _periodic ["name"] in periodics:
+			for key, value in sample.items ():
+				periodics [_periodic ["name"]][key] += value
+		else:
+			periodics [_periodic ["name"]] = sample
+
+	for periodic_name, sample in periodics.items ():
+		resourceUpdate (RESOURCES ["periodics"], periodic_name, sample, now)
+	RESOURCES ["periodics"] = {periodic_name: RESOURCES ["periodics"][periodic_name] for periodic_name in periodics}
+
+def resourceRun (interval:float):
+	while True:
+		try:
+			resourceSample ()
+		except Exception as err:
+			warning ("Resource sampling failed: %s: %s" % (err.__class__.__name__, str (err)))
+
+		time.sleep (interval)
+
+def resourceStart (interval:float):
+	if RESOURCES ["thread"] is not None:
+		return
 
-	os._exit (0)
+	RESOURCES ["thread"] = threading.Thread (target = resourceRun, args = (interval,), name = "resources", daemon = True)
+	RESOURCES ["thread"].start ()
+
+# ==============================================================================
+
+METRICS = {
+	"started": time.time (),
+	"restarts": {},
+	"log-lines": {},
+	"log-suppressed": {},
+	"log-file-dropped": {},
+	"periodic-runs": {},
+	"periodic-exits": {},
+	"periodic-duration": {},
+	"startup": {},
+	"orphans-reaped": 0,
+	"server": None
+}
+
+def metricsPeriodic (periodic_name:str, retcode:int, duration:float):
+	METRICS ["periodic-runs"][periodic_name] = METRICS ["periodic-runs"].get (periodic_name, 0) + 1
+
+	exits = METRICS ["periodic-exits"].setdefault (periodic_name, {})
+	exits [retcode] = exits.get (retcode, 0) + 1
+
+	durations = METRICS ["periodic-duration"].setdefault (periodic_name, {"sum": 0.0, "count": 0, "last": 0.0})
+	durations ["sum"] += duration
+	durations ["count"] += 1
+	durations ["last"] = duration
+
+def metricsSnapshot () -> dict:
+	now = time.time ()
+
+	# Copies are taken in one go each, so the supervisor never has to lock
+	# anything for the sake of a scrape
+	services = {}
+	for service_name, _service in list (SERVICES.items ()):
+		# Reaping is left to the main loop, the last status it saw is enough
+		running = _service ["process"] is not None and _service ["process"].returncode is None
+		services [service_name] = {
+			"state": _service ["state"],
+			"up": running,
+			"uptime": now - _service ["started"] if running else 0.0,
+			"ready": _service ["ready"].is_set () and _service ["ready-error"] is None,
+			"restarts": METRICS ["restarts"].get (service_name, 0)
+		}
+
+		if running and (resource := RESOURCES ["services"].get (service_name)) is not None:
+			services [service_name].update ({key: resource [key] for key in ("processes", "cpu", "rss", "read-rate", "write-rate")})
+
+	periodics = {}
+	running = collections.Counter ([_periodic ["name"] for _periodic in list (PERIODICS.values ())])
+	for periodic_name in list (CONFIG.periodic.keys () if CONFIG is not None else []):
+		durations = dict (METRICS ["periodic-duration"].get (periodic_name, {"sum": 0.0, "count": 0, "last": 0.0}))
+		periodics [periodic_name] = {
+			"running": running.get (periodic_name, 0),
+			"runs": METRICS ["periodic-runs"].get (periodic_name, 0),
+			"exit-codes": {str (code): count for code, count in list (METRICS ["periodic-exits"].get (periodic_name, {}).items ())},
+			"duration-sum": durations ["sum"],
+			"duration-count": durations ["count"],
+			"duration-last": durations ["last"]
+		}
+
+		if (resource := RESOURCES ["periodics"].get (periodic_name)) is not None:
+			periodics [periodic_name].update ({key: resource [key] for key in ("processes", "cpu", "rss", "read-rate", "write-rate")})
+
+	return {
+		"uptime": now - METRICS ["started"],
+		"services": services,
+		"periodics": periodics,
+		"log-lines": dict (METRICS ["log-lines"]),
+		"log-suppressed": dict (METRICS ["log-suppressed"]),
+		"log-file-dropped": dict (METRICS ["log-file-dropped"]),
+		"startup": {label: dict (task) for label, task in list (METRICS ["startup"].items ())},
+		"orphans-reaped": METRICS ["orphans-reaped"]
+	}
+
+def metricsLabel (value:str) -> str:
+	return str (value).replace ("\\", "\\\\").replace ("\"", "\\\"").replace ("\n", "\\n")
+
+def metricsText (snapshot:dict) -> str:
+	lines = []
+
+	def metric (name:str, kind:str, help:str, samples:list[tuple[dict, float]]):
+		lines.append ("# HELP %s %s" % (name, help))
+		lines.append ("# TYPE %s %s" % (name, kind))
+		for labels, value in samples:
+			label = ",".join (["%s=\"%s\"" % (key, metricsLabel (_value)) for key, _value in labels.items ()])
+			lines.append ("%s%s %s" % (name, "{%s}" % (label,) if len (label) > 0 else "", repr (float (value))))
+
+	services = snapshot ["services"]
+	periodics = snapshot ["periodics"]
+
+	metric ("regilo_uptime_seconds", "gauge", "Time since the supervisor started", [({}, snapshot ["uptime"])])
+	metric ("regilo_orphans_reaped_total", "counter", "Orphaned processes reaped by the supervisor", [({}, snapshot ["orphans-reaped"])])
+	metric ("regilo_service_up", "gauge", "Whether the service is running", [({"service": name}, service ["up"]) for name, service in services.items ()])
+	metric ("regilo_service_ready", "gauge", "Whether the service passed its readiness probe", [({"service": name}, service ["ready"]) for name, service in services.items ()])
+	metric ("regilo_service_state", "gauge", "The service's supervision state", [({"service": name, "state": service ["state"]}, 1) for name, service in services.items ()])
+	metric ("regilo_service_uptime_seconds", "gauge", "Time since the service was last started", [({"service": name}, service ["uptime"]) for name, service in services.items ()])
+	metric ("regilo_service_restarts_total", "counter", "Restarts after the service stopped unexpectedly", [({"service": name}, service ["restarts"]) for name, service in services.items ()])
+	for kind, items in (("service", services), ("periodic", periodics)):
+		sampled = [(name, item) for name, item in items.items () if "rss" in item]
+		metric ("regilo_%s_processes" % (kind,), "gauge", "Processes in the %s's tree" % (kind,), [({kind: name}, item ["processes"]) for name, item in sampled])
+		metric ("regilo_%s_cpu_percent" % (kind,), "gauge", "CPU use of the %s's tree over the sampling window" % (kind,), [({kind: name}, item ["cpu"]) for name, item in sampled])
+		metric ("regilo_%s_rss_bytes" % (kind,), "gauge", "Resident memory of the %s's tree" % (kind,), [({kind: name}, item ["rss"]) for name, item in sampled])
+		metric ("regilo_%s_read_bytes_per_second" % (kind,), "gauge", "Storage reads of the %s's tree over the sampling window" % (kind,), [({kind: name}, item ["read-rate"]) for name, item in sampled])
+		metric ("regilo_%s_write_bytes_per_second" % (kind,), "gauge", "Storage writes of the %s's tree over the sampling window" % (kind,), [({kind: name}, item ["write-rate"]) for name, item in sampled])
+	metric ("regilo_periodic_running", "gauge", "Runs of the periodic task in progress", [({"periodic": name}, periodic ["running"]) for name, periodic in periodics.items ()])
+	metric ("regilo_periodic_runs_total", "counter", "Finished runs of the periodic task", [({"periodic": name}, periodic ["runs"]) for name, periodic in periodics.items ()])
+	metric ("regilo_periodic_exits_total", "counter", "Finished runs of the periodic task by exit code", [({"periodic": name, "code": code}, count) for name, periodic in periodics.items () for code, count in periodic ["exit-codes"].items ()])
+	metric ("regilo_periodic_duration_seconds_sum", "counter", "Total run time of the periodic task", [({"periodic": name}, periodic ["duration-sum"]) for name, periodic in periodics.items ()])
+	metric ("regilo_periodic_duration_seconds_count", "counter", "Timed runs of the periodic task", [({"periodic": name}, periodic ["duration-count"]) for name, periodic in periodics.items ()])
+	metric ("regilo_periodic_last_duration_seconds", "gauge", "Run time of the last finished run", [({"periodic": name}, periodic ["duration-last"]) for name, periodic in periodics.items ()])
+	metric ("regilo_log_lines_total", "counter", "Output lines read from children", [({"source": name}, count) for name, count in snapshot ["log-lines"].items ()])
+	metric ("regilo_log_suppressed_total", "counter", "Output lines left out by rate limits and overflow", [({"source": name}, count) for name, count in snapshot ["log-suppressed"].items ()])
+	metric ("regilo_log_file_dropped_total", "counter", "Output lines the log file writer could not keep up with", [({"source": name}, count) for name, count in snapshot ["log-file-dropped"].items ()])
+	metric ("regilo_startup_task_duration_seconds", "gauge", "Run time of the startup task", [({"task": label, "result": task ["result"]}, task ["duration"]) for label, task in snapshot ["startup"].items ()])
+
+	return "\n".join (lines) + "\n"
+
+class MetricsHandler (http.server.BaseHTTPRequestHandler):
+	def do_GET (self):
+		path = self.path.split ("?", 1)[0]
+
+		if path == "/metrics":
+			body = bytes (metricsText (metricsSnapshot ()), "utf8")
+			content_type = "text/plain; version=0.0.4; charset=utf-8"
+		elif path == "/metrics.json":
+			body = bytes (json.dumps (metricsSnapshot (), separators = (",", ":")), "utf8")
+			content_type = "application/json"
+		else:
+			self.send_error (404)
+			return
+
+		self.send_response (200)
+		self.send_header ("Content-Type", content_type)
+		self.send_header ("Content-Length", str (len (body)))
+		self.end_headers ()
+		self.wfile.write (body)
+
+	def address_string (self) -> str:
+		# Unix socket peers have no address
+		return self.client_address [0] if isinstance (self.client_address, tuple) and len (self.client_address) > 0 else "unix"
+
+	def log_message (self, format:str, *args):
+		pass
+
+class MetricsUnixServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+def metricsStart (listen:str):
+	# Metrics are optional, not being able to serve them stops nothing else
+	try:
+		if listen.startswith ("unix:"):
+			path = listen [5:]
+			try:
+				os.unlink (path)
+			except FileNotFoundError:
+				pass
+			server = MetricsUnixServer (path, MetricsHandler)
+		else:
+			host, _, port = listen.rpartition (":")
+			server = http.server.ThreadingHTTPServer ((host.strip ("[]") or "127.0.0.1", int (port)), MetricsHandler)
+			server.daemon_threads = True
+	except OSError as err:
+		warning ("Cannot serve metrics on %s: %s" % (listen, err.strerror or str (err)))
+		return
+
+	# Scrapes are served from threads of their own, away from the main loop
+	METRICS ["server"] = server
+	threading.Thread (target = server.serve_forever, name = "metrics", daemon = True).start ()
+	info ("Serving metrics on %s" % (listen,))
+
+# ==============================================================================
+
+CONFIG_CACHE_FILE = "config.json"
+
+@dataclasses.dataclass (slots = True)
+class Banner:
+	lines:list = dataclasses.field (default_factory = list)
+	colors:list = dataclasses.field (default_factory = list)
+	indent:int = 0
+	title_spaces:int = 20
+
+@dataclasses.dataclass (slots = True)
+class Task:
+	type:str
+	name:str | None = None
+	description:str | None = None
+	needs:list | None = None
+	parallel_group:str | None = None
+	every_start:bool = True
+	inputs:list | None = None
+
+	# exec
+	path:str | None = None
+	args:list = dataclasses.field (default_factory = list)
+	workdir:str | None = None
+	user:str | None = None
+	group:str | None = None
+	environment:dict | None = None
+	output:bool = True
+	timeout:float | None = None
+
+	# template
+	source:str | None = None
+	target:dict | None = None
+	stream:bool | None = None
+
+	# tree
+	tree:dict | None = None
+
+	# The state log is keyed by the task as written in the config
+	key:str | None = dataclasses.field (default = None, metadata = {"config": False})
+
+@dataclasses.dataclass (slots = True)
+class Ready:
+	file:str | None = None
+	log:str | None = None
+	unix:str | None = None
+	tcp:str | int | dict | None = None
+	exec:dict | None = None
+	timeout:float | None = READY_TIMEOUT
+	interval:float = READY_INTERVAL
+	max_interval:float = READY_MAX_INTERVAL
+
+@dataclasses.dataclass (slots = True)
+class Service:
+	path:str
+	description:str | None = None
+	args:list = dataclasses.field (default_factory = list)
+	workdir:str | None = None
+	user:str | None = None
+	group:str | None = None
+	environment:dict | None = None
+	output:bool = True
+	needs:list = dataclasses.field (default_factory = list)
+	ready:Ready | None = None
+	restart:str = "always"
+	restart_action:str = "fail"
+	restart_limit:int | None = RESTART_LIMIT
+	restart_window:float = RESTART_WINDOW
+	restart_delay:float = RESTART_DELAY
+	restart_max_delay:float = RESTART_MAX_DELAY
+	restart_jitter:float = RESTART_JITTER
+	stop_signal:str | int | list = dataclasses.field (default_factory = lambda: list (STOP_SIGNALS))
+	stop_timeout:float = STOP_TIMEOUT
+	max_rss:int | str | None = None
+	max_cpu:float | None = None
+	log_rate_limit:float | None = None
+	log_rate_burst:int | None = None
+	log_overflow:str = "block"
+	log_file:str | None = None
+	log_max_size:int | str | None = None
+	log_max_age:float | None = None
+	log_keep:int = SINK_KEEP
+	log_compress:bool = True
+
+@dataclasses.dataclass (slots = True)
+class Periodic:
+	path:str
+	description:str | None = None
+	timing:str = ""
+	args:list = dataclasses.field (default_factory = list)
+	workdir:str | None = None
+	user:str | None = None
+	group:str | None = None
+	environment:dict | None = None
+	output:bool = True
+	allow_multiple:bool = False
+	max_concurrent:int | None = None
+	jitter:float = 0.0
+	timeout:float | None = None
+	catch_up:str = "once"
+	stop_signal:str | int | list = dataclasses.field (default_factory = lambda: list (STOP_SIGNALS))
+	stop_timeout:float = STOP_TIMEOUT
+
+@dataclasses.dataclass (slots = True)
+class Metrics:
+	listen:str
+
+@dataclasses.dataclass (slots = True)
+class Config:
+	title:str
+	banner:Banner = dataclasses.field (default_factory = Banner)
+	subtitle:str | None = None
+	description:str | None = None
+	repositories:dict = dataclasses.field (default_factory = dict)
+	authors:list = dataclasses.field (default_factory = list)
+	contributors:list = dataclasses.field (default_factory = list)
+	environment:dict = dataclasses.field (default_factory = dict)
+	startup:list = dataclasses.field (default_factory = list)
+	services:dict = dataclasses.field (default_factory = dict)
+	periodic:dict = dataclasses.field (default_factory = dict)
+	startup_workers:int | None = None
+	periodic_max_concurrent:int | None = None
+	spawn:str = "auto"
+	metrics:Metrics | None = None
+	sample_interval:float = RESOURCE_INTERVAL
+	log_format:str = "text"
+
+def configTypeName (_type:object) -> str:
+	return getattr (_type, "__name__", str (_type))
+
+def configBuild (kind:type, where:str, data:object, problems:list) -> object:
+	if not isinstance (data, dict):
+		problems.append ("%s must be an object" % (where,))
+		return None
+
+	count = len (problems)
+	values = {}
+	known = set ()
+
+	# Config keys are the field names with hyphens
+	for field in dataclasses.fields (kind):
+		if field.metadata.get ("config") == False:
+			continue
+
+		key = field.name.replace ("_", "-")
+		known.add (key)
+
+		if key not in data:
+			if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+				problems.append ("%s is missing %s" % (where, key))
+			continue
+
+		value = data [key]
+
+		# A null where there is a default has always meant the default
+		if value is None and type (None) not in getattr (field.type, "__args__", (field.type,)):
+			if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING:
+				problems.append ("%s.%s must be %s" % (where, key, configTypeName (field.type)))
+			continue
+
+		nested = [_type for _type in getattr (field.type, "__args__", (field.type,)) if dataclasses.is_dataclass (_type)]
+		if len (nested) > 0 and isinstance (value, dict):
+			value = configBuild (nested [0], "%s.%s" % (where, key), value, problems)
+
+		elif isinstance (value, int) and not isinstance (value, bool) and not isinstance (value, field.type) and isinstance (float (value), field.type):
+			value = float (value)
+
+		elif not isinstance (value, field.type) or (isinstance (value, bool) and bool not in getattr (field.type, "__args__", (field.type,))):
+			problems.append ("%s.%s must be %s" % (where, key, configTypeName (field.type)))
+			continue
+
+		values [field.name] = value
+
+	for key in data.keys ():
+		if key not in known:
+			warning ("%s has unknown key: %s" % (where, key))
+
+	if len (problems) > count:
+		return None
+
+	return kind (**values)
+
+def configChoice (where:str, value:str, choices:tuple, problems:list):
+	if value not in choices:
+		problems.append ("%s must be one of %s" % (where, ", ".join (choices)))
+
+def configSignals (where:str, value:object, problems:list):
+	for _signal in value if isinstance (value, list) else [value]:
+		try:
+			signalParse (_signal)
+		except (AttributeError, KeyError, ValueError):
+			problems.append ("%s has an unknown signal: %s" % (where, _signal))
+
+def configEnvironment (where:str, environment:dict, problems:list, unset:bool = True):
+	for key, value in (environment or {}).items ():
+		if not isinstance (value, str) and (unset == False or value is not None):
+			problems.append ("%s.%s must be a string%s" % (where, key, " or null" if unset == True else ""))
+
+CONFIG_SIZE_PATTERN = re.compile (r"(?i)^\s*([0-9]+(?:\.[0-9]+)?)\s*([kmgt]?)i?b?\s*$")
+
+def configSize (where:str, value:object, problems:list) -> int:
+	if value is None or isinstance (value, int):
+		return value
+
+	# Sizes can be given as bytes or with a binary K, M, G or T suffix
+	if (match := CONFIG_SIZE_PATTERN.match (value)) is None:
+		problems.append ("%s is not a size: %s" % (where, value))
+		return None
+
+	return int (float (match.group (1)) * 1024 ** " kmgt".index (match.group (2).lower () or " "))
+
+def configParse (data:object) -> tuple[Config, list[str]]:
+	problems = []
+
+	if not isinstance (data, dict):
+		return (None, ["Configuration must be an object"])
+
+	for key in ("startup", "services", "periodic"):
+		if data.get (key) is None:
+			data [key] = [] if key == "startup" else {}
+
+	config = configBuild (Config, "config", data, problems)
+	if config is None:
+		return (None, problems)
+
+	configEnvironment ("config.environment", config.environment, problems, False)
+	configChoice ("config.spawn", config.spawn, ("auto", "popen"), problems)
+	configChoice ("config.log-format", config.log_format, LOG_FORMATS, problems)
+	if config.metrics is not None and not config.metrics.listen.startswith ("unix:") and not config.metrics.listen.rpartition (":")[2].isdigit ():
+		problems.append ("config.metrics.listen must be host:port or unix:/path")
+
+	tasks = []
+	for index, raw in enumerate (config.startup):
+		where = "startup[%i]" % (index,)
+		if (task := configBuild (Task, where, raw, problems)) is None:
+			continue
+		task.key = generateKey (raw)
+
+		configChoice ("%s.type" % (where,), task.type, STARTUP_TASK_TYPES, problems)
+		configEnvironment ("%s.environment" % (where,), task.environment, problems)
+		if task.type == "exec" and task.path is None:
+			problems.append ("%s is missing path" % (where,))
+		elif task.type == "template":
+			if task.source is None:
+				problems.append ("%s is missing source" % (where,))
+			if task.target is None or task.target.get ("path") is None:
+				problems.append ("%s is missing target.path" % (where,))
+			else:
+				task.target = {"owner": None, "group": None, "permissions": None, **task.target}
+		elif task.type == "tree" and task.tree is None:
+			problems.append ("%s is missing tree" % (where,))
+
+		if task.description is None:
+			task.description = task.name or task.path or startupLabel (index, task)
+		tasks.append (task)
+	config.startup = tasks
+
+	services = {}
+	for service_name, raw in config.services.items ():
+		where = "services.%s" % (service_name,)
+		if (service := configBuild (Service, where, raw, problems)) is None:
+			continue
+
+		configChoice ("%s.restart" % (where,), service.restart, ("always", "on-failure", "never"), problems)
+		configChoice ("%s.restart-action" % (where,), service.restart_action, ("fail", "exit"), problems)
+		configSignals ("%s.stop-signal" % (where,), service.stop_signal, problems)
+		configEnvironment ("%s.environment" % (where,), service.environment, problems)
+		service.max_rss = configSize ("%s.max-rss" % (where,), service.max_rss, problems)
+		configChoice ("%s.log-overflow" % (where,), service.log_overflow, PUMP_OVERFLOW, problems)
+		if service.log_rate_limit is not None and service.log_rate_limit <= 0:
+			problems.append ("%s.log-rate-limit must be more than 0" % (where,))
+		if service.log_rate_burst is not None and service.log_rate_burst < 1:
+			problems.append ("%s.log-rate-burst must be at least 1" % (where,))
+		service.log_max_size = configSize ("%s.log-max-size" % (where,), service.log_max_size, problems)
+		if service.log_max_age is not None and service.log_max_age <= 0:
+			problems.append ("%s.log-max-age must be more than 0" % (where,))
+		if service.log_keep < 1:
+			problems.append ("%s.log-keep must be at least 1" % (where,))
+		if service.log_file is not None and service.output == False:
+			problems.append ("%s.log-file needs output to be enabled" % (where,))
+		if service.ready is not None and service.ready.exec is not None and service.ready.exec.get ("path") is None:
+			problems.append ("%s.ready.exec is missing path" % (where,))
+		if service.ready is not None and service.ready.log is not None:
+			try:
+				re.compile (service.ready.log)
+			except re.error as err:
+				problems.append ("%s.ready.log is invalid: %s" % (where, str (err)))
+
+			# Without output there are no log lines to watch
+			if service.output == False:
+				problems.append ("%s.ready.log needs output to be enabled" % (where,))
+
+		if service.description is None:
+			service.description = service_name
+		services [service_name] = service
+	# Dependencies are only worth checking once every service is known
+	if len (services) == len (config.services):
+		serviceLayers (services, problems)
+	config.services = services
+
+	periodics = {}
+	for periodic_name, raw in config.periodic.items ():
+		where = "periodic.%s" % (periodic_name,)
+		if (periodic := configBuild (Periodic, where, raw, problems)) is None:
+			continue
+
+		configChoice ("%s.catch-up" % (where,), periodic.catch_up, ("once", "all", "skip"), problems)
+		configSignals ("%s.stop-signal" % (where,), periodic.stop_signal, problems)
+		configEnvironment ("%s.environment" % (where,), periodic.environment, problems)
+		if periodic.timing != "":
+			try:
+				croniter (periodic.timing)
+			except ValueError as err:
+				problems.append ("%s.timing is invalid: %s" % (where, str (err)))
+
+		if periodic.description is None:
+			periodic.description = periodic_name
+		periodics [periodic_name] = periodic
+	config.periodic = periodics
+
+	if len (problems) > 0:
+		return (None, problems)
+
+	return (config, [])
+
+def configRestore (kind:type, data:dict) -> object:
+	values = {}
+
+	for field in dataclasses.fields (kind):
+		value = data [field.name]
+		nested = [_type for _type in getattr (field.type, "__args__", (field.type,)) if dataclasses.is_dataclass (_type)]
+		if len (nested) > 0 and isinstance (value, dict):
+			value = configRestore (nested [0], value)
+		values [field.name] = value
+
+	return kind (**values)
+
+def configCached (path:str, digest:str) -> Config:
+	try:
+		with open (path, "r") as file:
+			# Anything another user could have written is not trusted
+			stat = os.fstat (file.fileno ())
+			if stat.st_uid != os.getuid () or stat.st_mode & 0o022 != 0:
+				return None
+			cached = json.load (file)
+
+		if cached ["digest"] != digest:
+			return None
+
+		config = configRestore (Config, cached ["config"])
+		config.startup = [configRestore (Task, task) for task in config.startup]
+		config.services = {service_name: configRestore (Service, service) for service_name, service in config.services.items ()}
+		config.periodic = {periodic_name: configRestore (Periodic, periodic) for periodic_name, periodic in config.periodic.items ()}
+	except (OSError, ValueError, KeyError, TypeError, AttributeError):
+		return None
+
+	return config
+
+def configLoad (path:str) -> tuple[Config, list[str]]:
+	with open (path, "rb") as file:
+		data = file.read ()
+
+	# The cache is only good for the exact config and code that produced it
+	source = os.stat (__file__)
+	digest = sha256Hex (data + bytes ("\n%i:%i" % (source.st_size, source.st_mtime_ns), "ascii"))
+	cache = os.path.join (STARTUP_STATE_PATH, CONFIG_CACHE_FILE)
+
+	if (config := configCached (cache, digest)) is not None:
+		return (config, [])
+
+	config, problems = configParse (json.loads (data))
+	if config is None:
+		return (None, problems)
+
+	try:
+		content = json.dumps ({"digest": digest, "config": dataclasses.asdict (config)}, separators = (",", ":"))
+		fileReplace (cache, bytes (content, "utf8"), permissions = 0o600)
+	except OSError:
+		pass
+
+	return (config, [])
+
+# ------------------------------------------------------------------------------
+
+RELOAD = False
+
+def configReload ():
+	global CONFIG
+
+	notice ("Reloading configuration")
+	try:
+		config, problems = configLoad (CONFIG_JSON)
+	except (OSError, ValueError) as err:
+		config, problems = (None, ["%s: %s" % (err.__class__.__name__, str (err))])
+
+	if config is None:
+		for problem in problems:
+			error (problem)
+		error ("Configuration not reloaded")
+		return
+
+	old = CONFIG.services
+	new = config.services
+
+	removed = [service_name for service_name in old if service_name not in new]
+	changed = [service_name for service_name in old if service_name in new and old [service_name] != new [service_name]]
+	added = [service_name for service_name in new if service_name not in old]
+
+	layers = serviceLayers (new)
+
+	# Dependents are stopped before their dependencies, as on shutdown
+	stopping = set (removed + changed)
+	for layer in serviceStopLayers (old):
+		if len (service_names := [service_name for service_name in layer if service_name in stopping and service_name in SERVICES]) > 0:
+			servicesStop (service_names)
+
+	for service_name in removed + changed:
+		SERVICES.pop (service_name, None)
+		RESTARTS.pop (service_name, None)
+		if service_name in SERVICE_ORDER:
+			SERVICE_ORDER.remove (service_name)
+	for service_name in removed:
+		notice ("Service removed: %s" % (service_name,))
+
+	if config.metrics != CONFIG.metrics:
+		warning ("Metrics listen address changes take effect on restart")
+	if any ([service.max_rss is not None or service.max_cpu is not None for service in config.services.values ()]):
+		resourceStart (config.sample_interval)
+
+	CONFIG = config
+	OUTPUT ["format"] = config.log_format
+
+	# Only children started from here on see a changed environment
+	environmentBase (config.environment)
+	SPAWN ["backend"] = config.spawn
+	if environmentWrite (ENV_PATH, config.environment):
+		notice ("Environment written: %s" % (ENV_PATH,))
+
+	starting = set (changed + added)
+	if len (starting) > 0:
+		# A service that does not come up is reported, not fatal, as the rest
+		# keeps running
+		servicesStart (new, time.time (), [service_name for layer in layers for service_name in layer if service_name in starting], False)
+
+	# Running periodics finish with the definition they were started with,
+	# queued runs of removed ones are dropped
+	PERIODIC_QUEUE.extend ([entry for entry in [PERIODIC_QUEUE.popleft () for _ in range (len (PERIODIC_QUEUE))] if entry [0] in config.periodic])
+	PERIODIC_DELAYED [:] = [entry for entry in PERIODIC_DELAYED if entry [2] in config.periodic]
+	heapq.heapify (PERIODIC_DELAYED)
+	scheduleBuild (config.periodic)
+
+	notice ("Configuration reloaded: %i service(s) added, %i changed, %i removed" % (len (added), len (changed), len (removed)))
+
+# ==============================================================================
+
+STOPPING = False
+STOP_REQUESTED = None
+
+def signalStop (exit_code:int = 0):
+	global STOPPING
+
+	if STOPPING == True:
+		return
+	STOPPING = True
+
+	notice ("Shutting down")
+
+	# Every service in a layer is independent of the others in it, so each
+	# layer is stopped at once, dependents before their dependencies, and
+	# everything nothing depends on in the first one
+	if CONFIG is not None:
+		for layer in serviceStopLayers (CONFIG.services):
+			if len (service_names := [service_name for service_name in layer if service_name in SERVICES]) > 0:
+				servicesStop (service_names)
+
+	periodicsStop (list (PERIODICS.keys ()))
+	childrenStop ()
+
+	sinkExit ()
+	outputFlush ()
+	os._exit (exit_code)
+
+def stopCheck ():
+	if STOP_REQUESTED is not None:
+		signalStop (STOP_REQUESTED)
 
 def signalHandler (signal_number:int, frame):
+	global REAP, RELOAD, STOP_REQUESTED
+
+	# Handlers only set flags for the main thread to act on once the signal
+	# has woken it up, as the code they interrupt may hold the output lock
 	if signal_number in (signal.SIGINT, signal.SIGTERM, signal.SIGPIPE):
-		signalStop ()
+		if STOP_REQUESTED is None:
+			STOP_REQUESTED = 0
+
+	elif signal_number == signal.SIGHUP:
+		RELOAD = True
+
+	# The wakeup pipe takes care of waking the supervisor up
+	elif signal_number == signal.SIGCHLD:
+		REAP = True
 
 # ==============================================================================
 
 def main ():
+	global CONFIG, REAP, RELOAD
+
 	signal.signal (signal.SIGINT, signalHandler)
 	signal.signal (signal.SIGTERM, signalHandler)
 	signal.signal (signal.SIGPIPE, signalHandler)
+	signal.signal (signal.SIGHUP, signalHandler)
+	supervisorInit ()
+	supervisorSubreaper ()
 
 	try:
-		with open (CONFIG_JSON, "r") as file:
-			CONFIG = json.load (file)
-
-		banner_print (
-			banner_string = "\n".join (CONFIG ["banner"]["lines"]),
-			banner_colors = CONFIG ["banner"]["colors"],
-			banner_indent = CONFIG ["banner"]["indent"],
-			title_spaces = CONFIG ["banner"]["title-spaces"],
-
-			title = CONFIG ["title"],
-			subtitle = CONFIG ["subtitle"],
-			description = CONFIG ["description"],
-			repositories = CONFIG ["repositories"],
-			authors = CONFIG ["authors"],
-			contributors = CONFIG ["contributors"],
-		)
-
-		separator ()
+		CONFIG, problems = configLoad (CONFIG_JSON)
+		if CONFIG is None:
+			for problem in problems:
+				error (problem)
+			fatal ("Configuration is invalid")
+
+		OUTPUT ["format"] = CONFIG.log_format
+
+		# Nothing but records in JSON mode
+		if CONFIG.log_format == "text":
+			banner_print (
+				banner_string = "\n".join (CONFIG.banner.lines),
+				banner_colors = CONFIG.banner.colors,
+				banner_indent = CONFIG.banner.indent,
+				title_spaces = CONFIG.banner.title_spaces,
+
+				title = CONFIG.title,
+				subtitle = CONFIG.subtitle,
+				description = CONFIG.description,
+				repositories = CONFIG.repositories,
+				authors = CONFIG.authors,
+				contributors = CONFIG.contributors,
+			)
+
+			separator ()
+
+		environmentBase (CONFIG.environment)
+		SPAWN ["backend"] = CONFIG.spawn
 
 		info ("Writing %s" % (ENV_PATH,))
-		with open (ENV_PATH, "w") as file:
-			for key, value in CONFIG ["environment"].items ():
-				if key not in os.environ:
-					file.write ("%s=\"%s\"\n" % (key, shlex.quote (value)))
-			for key, value in os.environ.items ():
-				if key in CONFIG ["environment"]:
-					file.write ("%s=\"%s\"\n" % (key, shlex.quote (value)))
-		wrapOutput ("   written")
+		if environmentWrite (ENV_PATH, CONFIG.environment):
+			wrapOutput ("   written")
+		else:
+			wrapOutput ("   unchanged")
 
 		info ("Ensuring needed directory structure")
 		ensureTree (pathToTree (STARTUP_STATE_PATH))
 
-		for _, task in enumerate (CONFIG ["startup"]):
-			if task ["type"] == "exec":
-				task_key = generateKey (task)
+		if CONFIG.metrics is not None:
+			metricsStart (CONFIG.metrics.listen)
+		if CONFIG.metrics is not None or any ([service.max_rss is not None or service.max_cpu is not None for service in CONFIG.services.values ()]):
+			resourceStart (CONFIG.sample_interval)
 
-				if task ["every-start"] == False and os.path.exists ("%s/%s" % (STARTUP_STATE_PATH, task_key,)):
-					notice ("Skipping startup task: %s" % (task ["description"],))
-					continue
-
-				notice ("Running startup task: %s" % (task ["description"],))
-				retcode = execProcess (
-					path = task ["path"],
-					args = task ["args"],
-					workdir = task ["workdir"],
-					user = task ["user"],
-					group = task ["group"],
-					environment = None,
-					output = task ["output"]
-				)
-				if retcode != 0:
-					fatal ("Startup task %s failed with exit code %i" % (task ["description"], retcode))
-
-				with open ("%s/%s" % (STARTUP_STATE_PATH, task_key,), "w") as file:
-					file.write ("")
-
-			elif task ["type"] == "template":
-				task_key = generateKey (task)
-
-				if task ["every-start"] == False and os.path.exists ("%s/%s" % (STARTUP_STATE_PATH, task_key,)):
-					notice ("Skipping template: %s" % (task ["target"]["path"],))
-					continue
-
-				notice ("Filling in template: %s" % (task ["target"]["path"],))
-				fillTemplate (task, CONFIG ["environment"])
-
-				with open ("%s/%s" % (STARTUP_STATE_PATH, task_key,), "w") as file:
-					file.write ("")
+		startupRun (CONFIG.startup, CONFIG.startup_workers)
 
-			elif task ["type"] == "tree":
-				notice ("Creating directory tree: %s" % (task ["description"],))
-				ensureTree (task ["tree"])
+		if CONFIG.log_format == "text":
+			separator ()
 
-			else:
-				fatal ("Unknown startup task type: %s" % (task ["type"]))
-
-		separator ()
+		boot_start = time.time ()
+		servicesStart (CONFIG.services, boot_start)
+		notice ("All services started in %.3fs" % (time.time () - boot_start,))
 
+		scheduleBuild (CONFIG.periodic)
 		while True:
-			started = 0
-			for service_name, service in CONFIG ["services"].items ():
-				if (service.get ("needs") is None or len (service ["needs"]) == 0) and service_name not in SERVICES:
-					# Start service
-					started += 1
-					notice ("Starting service: %s (%s)" % (service ["description"], service_name))
-					SERVICE_ORDER.append (service_name)
+			stopCheck ()
+
+			if RELOAD == True and STOPPING == False:
+				RELOAD = False
+				configReload ()
+
+			# Orphans handed to the supervisor are reaped as they exit, before
+			# they can pile up as zombies
+			if REAP == True:
+				REAP = False
+				childrenReap ()
+
+			wake = None
+			for service_name, _service in list (SERVICES.items ()):
+				if _service ["process"] is not None and (retcode := _service ["process"].poll ()) is not None:
+					serviceExited (service_name, retcode)
+
+				# Services over their resource limits are restarted gracefully
+				# before the OOM killer gets to pick something
+				elif _service.get ("recycle") is not None and _service ["state"] == "running":
+					warning ("Recycling service %s, %s" % (service_name, _service ["recycle"]))
+					service = _service ["definition"]
+					serviceStop (service_name)
+					METRICS ["restarts"][service_name] = METRICS ["restarts"].get (service_name, 0) + 1
+					notice ("Starting service: %s (%s)" % (service.description, service_name))
 					serviceStart (service_name, service)
-					notice ("Service started: %s" % (service_name))
-
-				elif service.get ("needs") is not None and len (service ["needs"]) > 0 and service_name not in SERVICES:
-					for needs in service ["needs"]:
-						if needs not in SERVICES:
-							break
-					else:
-						# Start service
-						started += 1
-						notice ("Starting service: %s (%s)" % (service ["description"], service_name))
-						SERVICE_ORDER.append (service_name)
-						serviceStart (service_name, service)
-						notice ("Service started: %s" % (service_name))
-
-			if started == 0:
-				break
+					notice ("Service started: %s" % (service_name,))
+					continue
 
-		last_minute = int (time.time () / 60)
-		while True:
-			for service_name, _service in SERVICES.items ():
-				service = CONFIG ["services"][service_name]
+				if _service ["state"] != "backoff":
+					continue
 
-				if (retcode := _service ["process"].poll ()) is not None:
-					warning ("Service unexpectedly stopped: %s" % (service_name))
-					notice ("Stopping service: %s" % (service_name))
-					serviceStop (service_name)
-					notice ("Service stopped: %s" % (service_name))
-					notice ("Starting service: %s (%s)" % (service ["description"], service_name))
+				if _service ["restart-at"] <= time.monotonic ():
+					service = _service ["definition"]
+					notice ("Starting service: %s (%s)" % (service.description, service_name))
 					serviceStart (service_name, service)
 					notice ("Service started: %s" % (service_name))
+				elif wake is None or _service ["restart-at"] < wake:
+					wake = _service ["restart-at"]
 
-			periodic_keys = list (PERIODICS.keys ())
-			for periodic_id in periodic_keys:
-				_periodic = PERIODICS [periodic_id]
-
+			for periodic_id, _periodic in list (PERIODICS.items ()):
 				if (retcode := _periodic ["process"].poll ()) is not None:
-					notice ("Periodic task ended: %s" % (periodic_id))
+					duration = time.monotonic () - _periodic ["started"]
+					notice ("Periodic task ended: %s (exit code %i, %.3fs)" % (periodic_id, retcode, duration))
+					metricsPeriodic (_periodic ["name"], retcode, duration)
 					periodicStop (periodic_id)
-					notice ("Periodic task tidied: %s" % (periodic_id))
-
-			current_minute = int (time.time () / 60)
-			if last_minute == current_minute:
-				continue
-
-			last_minute = current_minute
-			for periodic_name, periodic in CONFIG ["periodic"].items ():
-				if "timing" not in periodic or periodic ["timing"] == "":
-					continue
 
-				if croniter.match (periodic ["timing"], datetime.datetime.now ()) == True:
-					if periodic_name in PERIODICS:
-						warning ("Periodic still running: %s" % (periodic_name))
-						continue
+			for periodic_name, runs in scheduleDue (CONFIG.periodic, time.time ()):
+				for _ in range (runs):
+					periodicFire (periodic_name, CONFIG.periodic [periodic_name])
 
-					notice ("Starting periodic: %s (%s)" % (periodic ["description"], periodic_name))
-					periodicStart (periodic_name, periodic)
-					notice ("Periodic started: %s" % (periodic_name))
+			if (periodic_wake := periodicsDispatch (CONFIG.periodic, CONFIG.periodic_max_concurrent)) is not None:
+				wake = periodic_wake if wake is None else min (wake, periodic_wake)
 
-			time.sleep (0.2)
+			# Sleep until a child exits, a signal arrives, a restart, delayed
+			# periodic or periodic timeout is due, or the next periodic fires
+			timeout = None
+			if (next_fire := scheduleNext ()) is not None:
+				timeout = next_fire - time.time ()
+			if wake is not None:
+				timeout = wake - time.monotonic () if timeout is None else min (timeout, wake - time.monotonic ())
+			supervisorWait (timeout)
 
 	except Exception as err:
 		error ("%s: %s" % (err.__class__.__name__, str (err)))
+		outputFlush ()
 		raise err
 
 # ==============================================================================